@@ -1,36 +1,62 @@
 import jwt
 import hashlib
-import secrets
+import hmac
+import threading
+import time
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from datetime import datetime, timedelta
 from typing import Optional, Dict
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from cachetools import TTLCache
+from database import get_db
 import os
 
+# Argon2id parameters follow the OWASP minimum recommendation
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 class AuthManager:
     def __init__(self):
         self.secret_key = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-this-in-production")
         self.algorithm = "HS256"
         self.access_token_expire_minutes = 30
         
+        # Precomputed once so per-request encode/decode skips key conversion
+        self._key_bytes = self.secret_key.encode()
+        self._algorithms = [self.algorithm]
+        self._decode_options = {"require": ["exp", "user_id"]}
+        
     def hash_password(self, password: str) -> str:
-        """Hash password using SHA-256 with salt"""
-        salt = secrets.token_hex(16)
-        password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-        return f"{salt}:{password_hash}"
+        """Hash password using Argon2id (salt is embedded in the encoded hash)"""
+        return _ph.hash(password)
     
     def verify_password(self, password: str, hashed_password: str) -> bool:
         """Verify password against hash"""
+        if not hashed_password.startswith("$argon2"):
+            return self._verify_legacy_password(password, hashed_password)
+        try:
+            return _ph.verify(hashed_password, password)
+        except (VerificationError, InvalidHash):
+            return False
+    
+    def _verify_legacy_password(self, password: str, hashed_password: str) -> bool:
+        """Verify password against a legacy salt:sha256 hash"""
         try:
             salt, password_hash = hashed_password.split(":")
-            return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
+            return hmac.compare_digest(hashlib.sha256((password + salt).encode()).hexdigest(), password_hash)
         except:
             return False
     
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Check if a stored hash is legacy or uses outdated Argon2 parameters"""
+        if not hashed_password.startswith("$argon2"):
+            return True
+        return _ph.check_needs_rehash(hashed_password)
+    
     def create_user(self, username: str, email: str, password: str) -> str:
         """Create a new user and return user_id"""
-        from database import DatabaseManager
-        db_manager = DatabaseManager()
+        db_manager = get_db()
         
         # Check if user already exists
         if db_manager.user_exists(email):
@@ -45,14 +71,16 @@ class AuthManager:
     
     def authenticate_user(self, email: str, password: str) -> Optional[Dict]:
         """Authenticate user and return user data"""
-        from database import DatabaseManager
-        db_manager = DatabaseManager()
+        db_manager = get_db()
         
         user = db_manager.get_user_by_email(email)
         if not user:
             return None
         
         if self.verify_password(password, user["password"]):
+            # Transparently upgrade legacy or outdated hashes on successful login
+            if self.needs_rehash(user["password"]):
+                db_manager.update_user(user["user_id"], {"password": self.hash_password(password)})
             return {
                 "user_id": user["user_id"],
                 "username": user["username"],
@@ -62,32 +90,51 @@ class AuthManager:
     
     def create_access_token(self, user_id: str) -> str:
         """Create JWT access token"""
-        expire = datetime.utcnow() + timedelta(minutes=self.access_token_expire_minutes)
+        now = datetime.utcnow()
         payload = {
             "user_id": user_id,
-            "exp": expire,
-            "iat": datetime.utcnow()
+            "exp": now + timedelta(minutes=self.access_token_expire_minutes),
+            "iat": now
         }
-        token = jwt.encode(payload, self.secret_key, algorithm=self.algorithm)
+        token = jwt.encode(payload, self._key_bytes, algorithm=self.algorithm)
         return token
     
     def verify_token(self, token: str) -> Optional[Dict]:
         """Verify JWT token and return payload"""
         try:
-            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            payload = jwt.decode(
+                token,
+                self._key_bytes,
+                algorithms=self._algorithms,
+                options=self._decode_options
+            )
             return payload
-        except jwt.ExpiredSignatureError:
-            return None
-        except jwt.JWTError:
+        except jwt.PyJWTError:
             return None
 
 # Global auth manager instance
 auth_manager = AuthManager()
 security = HTTPBearer()
 
+# Validated token cache: blake2b(token) -> (expires_at, user). Entries never
+# outlive the token's own exp claim; failed verifications are never cached.
+_token_cache_ttl = float(os.getenv("JWT_CACHE_TTL", "10"))
+_token_cache = TTLCache(maxsize=int(os.getenv("JWT_CACHE_MAX", "10000")), ttl=_token_cache_ttl)
+_token_cache_lock = threading.Lock()
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
     """Dependency to get current authenticated user"""
     token = credentials.credentials
+    cache_key = _token_cache_key(token)
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
     payload = auth_manager.verify_token(token)
     
     if payload is None:
@@ -106,8 +153,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         )
     
     # Get user data from database
-    from database import DatabaseManager
-    db_manager = DatabaseManager()
+    db_manager = get_db()
     user = db_manager.get_user_by_id(user_id)
     
     if user is None:
@@ -117,10 +163,16 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return {
+    user_data = {
         "user_id": user["user_id"],
         "username": user["username"],
         "email": user["email"]
     }
+    
+    expires_at = min(payload["exp"], now + _token_cache_ttl)
+    with _token_cache_lock:
+        _token_cache[cache_key] = (expires_at, user_data)
+    
+    return user_data
 
 
@@ -1,30 +1,46 @@
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel
 from datetime import datetime
 import os
+import threading
 from typing import Dict, List, Optional
 import uuid
+from cachetools import TTLCache
 
 class DatabaseManager:
+    _indexes_built = False
+    
     def __init__(self):
-        # MongoDB connection
+        # MongoDB connection (pooled, reused across requests)
         mongodb_url = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-        self.client = MongoClient(mongodb_url)
+        self.client = MongoClient(mongodb_url, maxPoolSize=100, minPoolSize=10)
         self.db = self.client.rag_chatbot
         
         # Collections
         self.users = self.db.users
         self.content_metadata = self.db.content_metadata
         
-        # Create indexes
-        self._create_indexes()
+        # Short-lived user_id -> user cache; evicted on update/delete
+        self._user_cache = TTLCache(maxsize=4096, ttl=5)
+        self._user_cache_lock = threading.Lock()
+        
+        # Create indexes once per process
+        self._create_indexes(self.db)
     
-    def _create_indexes(self):
-        """Create database indexes for better performance"""
-        self.users.create_index("email", unique=True)
-        self.users.create_index("user_id", unique=True)
-        self.content_metadata.create_index([("user_id", 1), ("content_id", 1)], unique=True)
-        self.content_metadata.create_index("user_id")
+    @classmethod
+    def _create_indexes(cls, db):
+        """Create database indexes for better performance (once per process)"""
+        if cls._indexes_built:
+            return
+        db.users.create_indexes([
+            IndexModel("email", unique=True),
+            IndexModel("user_id", unique=True)
+        ])
+        db.content_metadata.create_indexes([
+            IndexModel([("user_id", 1), ("content_id", 1)], unique=True),
+            IndexModel("user_id")
+        ])
+        cls._indexes_built = True
     
     def user_exists(self, email: str) -> bool:
         """Check if user exists by email"""
@@ -33,30 +49,38 @@ class DatabaseManager:
     def create_user(self, username: str, email: str, hashed_password: str) -> str:
         """Create a new user and return user_id"""
         user_id = str(uuid.uuid4())
+        now_iso = datetime.now().isoformat()
         user_doc = {
             "user_id": user_id,
             "username": username,
             "email": email,
             "password": hashed_password,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+            "created_at": now_iso,
+            "updated_at": now_iso
         }
         self.users.insert_one(user_doc)
         return user_id
     
     def get_user_by_email(self, email: str) -> Optional[Dict]:
-        """Get user by email"""
-        user = self.users.find_one({"email": email})
-        if user:
-            user["_id"] = str(user["_id"])  # Convert ObjectId to string
-        return user
+        """Get user by email (includes the password hash for authentication)"""
+        return self.users.find_one({"email": email}, {"_id": 0})
     
     def get_user_by_id(self, user_id: str) -> Optional[Dict]:
-        """Get user by user_id"""
-        user = self.users.find_one({"user_id": user_id})
-        if user:
-            user["_id"] = str(user["_id"])  # Convert ObjectId to string
-        return user
+        """Get user by user_id (without the password hash)"""
+        with self._user_cache_lock:
+            user = self._user_cache.get(user_id)
+        if user is None:
+            user = self.users.find_one({"user_id": user_id}, {"_id": 0, "password": 0})
+            if user is None:
+                return None
+            with self._user_cache_lock:
+                self._user_cache[user_id] = user
+        return dict(user)
+    
+    def _evict_user(self, user_id: str):
+        """Drop a user from the lookup cache after it changes"""
+        with self._user_cache_lock:
+            self._user_cache.pop(user_id, None)
     
     def save_content_metadata(self, user_id: str, content_id: str, metadata: Dict):
         """Save content metadata"""
@@ -70,18 +94,11 @@ class DatabaseManager:
     
     def get_user_content(self, user_id: str) -> List[Dict]:
         """Get all content for a user"""
-        content_list = []
-        cursor = self.content_metadata.find({"user_id": user_id})
-        
-        for doc in cursor:
-            doc["_id"] = str(doc["_id"])  # Convert ObjectId to string
-            content_list.append({
-                "content_id": doc["content_id"],
-                "metadata": doc["metadata"],
-                "created_at": doc["created_at"]
-            })
-        
-        return content_list
+        cursor = self.content_metadata.find(
+            {"user_id": user_id},
+            {"_id": 0, "content_id": 1, "metadata": 1, "created_at": 1}
+        )
+        return list(cursor)
     
     def delete_content_metadata(self, user_id: str, content_id: str):
         """Delete content metadata"""
@@ -97,23 +114,36 @@ class DatabaseManager:
             {"user_id": user_id},
             {"$set": update_data}
         )
+        self._evict_user(user_id)
     
     def delete_user(self, user_id: str):
         """Delete user and all associated data"""
         # Delete user
         self.users.delete_one({"user_id": user_id})
+        self._evict_user(user_id)
         
         # Delete user's content metadata
         self.content_metadata.delete_many({"user_id": user_id})
     
     def get_stats(self, user_id: str) -> Dict:
         """Get user statistics"""
-        content_count = self.content_metadata.count_documents({"user_id": user_id})
+        counts = list(self.content_metadata.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$count": "content_count"}
+        ]))
         user = self.get_user_by_id(user_id)
         
         return {
-            "content_count": content_count,
+            "content_count": counts[0]["content_count"] if counts else 0,
             "created_at": user["created_at"] if user else None
         }
 
+# Process-wide database manager
+_db_singleton = None
 
+def get_db() -> DatabaseManager:
+    """Return the shared DatabaseManager, creating it on first use"""
+    global _db_singleton
+    if _db_singleton is None:
+        _db_singleton = DatabaseManager()
+    return _db_singleton
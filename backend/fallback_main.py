@@ -1,20 +1,44 @@
 from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import uvicorn
 import os
 import logging
 import time
+from uuid import uuid4
 from typing import List, Optional
 import jwt
 from datetime import datetime, timedelta
 import hashlib
-import secrets
+import hmac
+import threading
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from dotenv import load_dotenv
+from cachetools import TTLCache
+import aiofiles
+import aiofiles.tempfile
 import PyPDF2
 import docx
 import csv
-import io
+import re
+from collections import defaultdict
+from itertools import repeat
+from file_processing import (
+    FileProcessor, PDF_PARALLEL_MIN_PAGES, PDF_WORKERS, get_pdf_pool, shutdown_pdf_pool,
+    _pdf_page_ranges, _extract_pdf_page_range
+)
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,7 +46,7 @@ logging.basicConfig(level=logging.INFO)
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="RAG Chatbot API", version="1.0.0")
+app = FastAPI(title="RAG Chatbot API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -37,76 +61,163 @@ app.add_middleware(
 users_db = {}
 tokens_db = {}
 uploaded_content = {}
+user_to_content_ids: dict[str, list[str]] = defaultdict(list)  # user_id -> content_ids
+
+# First characters of each user's first two documents, kept in sync on upload
+DOC_PREVIEW_LENGTH = 200
+user_doc_preview: dict[str, str] = {}
+
+def refresh_doc_preview(user_id: str):
+    """Recompute the cached document preview for a user"""
+    content_ids = user_to_content_ids.get(user_id)
+    if not content_ids:
+        user_doc_preview.pop(user_id, None)
+        return
+    first_docs = (uploaded_content[cid].get('content', '')[:DOC_PREVIEW_LENGTH] for cid in content_ids[:2])
+    user_doc_preview[user_id] = " ".join(first_docs)[:DOC_PREVIEW_LENGTH]
+
+# Used to reject unsupported or oversized uploads before reading them
+file_processor = FileProcessor()
+
+# The PDF worker pool is shared with FileProcessor and stopped with the app
+app.on_event("shutdown")(shutdown_pdf_pool)
+
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 16
 
 # Text extraction functions
-def extract_text_from_pdf(content):
-    """Extract text from PDF content"""
+def extract_text_from_pdf(file_path):
+    """Extract text from a PDF file"""
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text.strip()
+        if fitz is not None:
+            with fitz.open(file_path) as doc:
+                page_count = len(doc)
+                if page_count <= PDF_PARALLEL_MIN_PAGES:
+                    return "\n".join(page.get_text("text") for page in doc).strip()
+            
+            # MuPDF is not thread-safe, so large PDFs are split across processes
+            ranges = _pdf_page_ranges(page_count, PDF_WORKERS)
+            parts = get_pdf_pool().map(
+                _extract_pdf_page_range,
+                repeat(file_path),
+                [start for start, _ in ranges],
+                [end for _, end in ranges]
+            )
+            return "\n".join(parts).strip()
+        
+        pdf_reader = PyPDF2.PdfReader(file_path)
+        return "\n".join(page.extract_text() for page in pdf_reader.pages).strip()
     except Exception as e:
         logging.error(f"Error extracting PDF text: {e}")
         return f"Error extracting PDF content: {str(e)}"
 
-def extract_text_from_docx(content):
-    """Extract text from DOCX content"""
+def extract_text_from_docx(file_path):
+    """Extract text from a DOCX file"""
     try:
-        doc = docx.Document(io.BytesIO(content))
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text.strip()
+        doc = docx.Document(file_path)
+        return "\n".join(paragraph.text for paragraph in doc.paragraphs).strip()
     except Exception as e:
         logging.error(f"Error extracting DOCX text: {e}")
         return f"Error extracting DOCX content: {str(e)}"
 
-def extract_text_from_csv(content):
-    """Extract text from CSV content"""
+def extract_text_from_csv(file_path):
+    """Extract text from a CSV file"""
     try:
-        csv_reader = csv.reader(io.StringIO(content.decode('utf-8')))
-        text = ""
-        for row in csv_reader:
-            text += ", ".join(row) + "\n"
-        return text.strip()
+        with open(file_path, newline='', encoding='utf-8') as f:
+            return "\n".join(", ".join(row) for row in csv.reader(f)).strip()
     except Exception as e:
         logging.error(f"Error extracting CSV text: {e}")
         return f"Error extracting CSV content: {str(e)}"
 
-def extract_text_from_file(file):
-    """Extract text from uploaded file"""
-    content = file.file.read()
-    file_extension = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
+def extract_text_from_plain(file_path):
+    """Extract text from a plain text / markdown file"""
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('utf-8', errors='ignore')
+
+# Extension -> extractor, built once at import
+TEXT_EXTRACTORS = {
+    "pdf": extract_text_from_pdf,
+    "docx": extract_text_from_docx,
+    "csv": extract_text_from_csv,
+    "txt": extract_text_from_plain,
+    "md": extract_text_from_plain,
+}
+
+def sniff_file_extension(file_path):
+    """Guess the extension of an extensionless upload from its magic number"""
+    with open(file_path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        return "docx"
+    return ""
+
+def extract_text_from_file(file_path, filename):
+    """Extract text from an uploaded file saved at file_path"""
+    file_extension = os.path.splitext(filename)[1][1:].lower()
+    if not file_extension:
+        file_extension = sniff_file_extension(file_path)
     
-    if file_extension in ['txt', 'md']:
-        try:
-            return content.decode('utf-8')
-        except UnicodeDecodeError:
-            return content.decode('utf-8', errors='ignore')
-    elif file_extension == 'pdf':
-        return extract_text_from_pdf(content)
-    elif file_extension == 'docx':
-        return extract_text_from_docx(content)
-    elif file_extension == 'csv':
-        return extract_text_from_csv(content)
-    else:
-        return f"Content from {file.filename} (file type: {file_extension} - text extraction not supported)"
+    extractor = TEXT_EXTRACTORS.get(file_extension)
+    if extractor is None:
+        return f"Content from {filename} (file type: {file_extension} - text extraction not supported)"
+    return extractor(file_path)
+
+async def save_upload_to_tempfile(file: UploadFile, max_size: int) -> str:
+    """Stream an upload to a named temp file without buffering it in memory.
+    
+    Raises a 413 as soon as more than max_size bytes have been received.
+    """
+    suffix = os.path.splitext(file.filename)[1]
+    size = 0
+    too_large = False
+    async with aiofiles.tempfile.NamedTemporaryFile('wb', suffix=suffix, delete=False) as tmp:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                too_large = True
+                break
+            await tmp.write(chunk)
+        tmp_path = tmp.name
+    
+    if too_large:
+        os.remove(tmp_path)
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {max_size // (1024*1024)}MB"
+        )
+    return tmp_path
 
 # Simple auth functions
+# Argon2id parameters follow the OWASP minimum recommendation
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 def hash_password(password: str) -> str:
-    salt = secrets.token_hex(16)
-    password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}:{password_hash}"
+    return _ph.hash(password)
 
 def verify_password(password: str, hashed_password: str) -> bool:
+    if not hashed_password.startswith("$argon2"):
+        # Legacy salt:sha256 hash
+        try:
+            salt, password_hash = hashed_password.split(":")
+            return hmac.compare_digest(hashlib.sha256((password + salt).encode()).hexdigest(), password_hash)
+        except:
+            return False
     try:
-        salt, password_hash = hashed_password.split(":")
-        return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
-    except:
+        return _ph.verify(hashed_password, password)
+    except (VerificationError, InvalidHash):
         return False
 
+def needs_rehash(hashed_password: str) -> bool:
+    if not hashed_password.startswith("$argon2"):
+        return True
+    return _ph.check_needs_rehash(hashed_password)
+
 def create_token(user_id: str) -> str:
     payload = {
         "user_id": user_id,
@@ -126,14 +237,31 @@ def verify_token(token: str) -> Optional[dict]:
         print(f"DEBUG: Token verification failed: {e}")
         return None
 
+# Validated token cache: blake2b(token) -> (expires_at, payload). Entries never
+# outlive the token's own exp claim; failed verifications are never cached.
+_token_cache_ttl = float(os.getenv("JWT_CACHE_TTL", "10"))
+_token_cache = TTLCache(maxsize=int(os.getenv("JWT_CACHE_MAX", "10000")), ttl=_token_cache_ttl)
+_token_cache_lock = threading.Lock()
+
 # Simple auth dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
     token = credentials.credentials
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
     payload = verify_token(token)
     
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     
+    expires_at = min(payload["exp"], now + _token_cache_ttl)
+    with _token_cache_lock:
+        _token_cache[cache_key] = (expires_at, payload)
+    
     return payload
 
 # Knowledge base for responses
@@ -155,30 +283,67 @@ KNOWLEDGE_BASE = {
     "help": "I'm here to help! You can ask me questions about various topics, or if you upload documents, I can answer questions based on their content."
 }
 
-def get_response(message: str, user_documents: List[str] = None):
-    """Get response based on message and user documents"""
-    message_lower = message.lower().strip()
+GREETING_PHRASES = ["hello", "hi", "hey", "good morning", "good afternoon", "good evening"]
+GREETING_RESPONSE = "Hello! I'm your AI assistant. How can I help you today?"
+
+HOW_ARE_YOU_PHRASES = ["how are you", "how are u", "how do you do", "how's it going"]
+HOW_ARE_YOU_RESPONSE = "I'm doing well, thank you for asking! I'm here and ready to help you with any questions or tasks you have."
+
+def _response_entries():
+    """Canned-response phrases as (phrase, (priority, order, response)).
     
-    # Check for greetings
-    if any(greeting in message_lower for greeting in ["hello", "hi", "hey", "good morning", "good afternoon", "good evening"]):
-        return "Hello! I'm your AI assistant. How can I help you today?"
+    The lowest entry among all matches wins: greetings, then "how are you"
+    variations, then knowledge base keys in order.
+    """
+    return (
+        [(phrase, (0, i, GREETING_RESPONSE)) for i, phrase in enumerate(GREETING_PHRASES)]
+        + [(phrase, (1, i, HOW_ARE_YOU_RESPONSE)) for i, phrase in enumerate(HOW_ARE_YOU_PHRASES)]
+        + [(key, (2, i, value)) for i, (key, value) in enumerate(KNOWLEDGE_BASE.items())]
+    )
+
+def _build_response_automaton():
+    """Build one Aho-Corasick automaton over all canned-response phrases"""
+    automaton = ahocorasick.Automaton()
+    for phrase, entry in _response_entries():
+        existing = automaton.get(phrase, None)
+        if existing is None or entry < existing:
+            automaton.add_word(phrase, entry)
+    automaton.make_automaton()
+    return automaton
+
+def _build_response_pattern():
+    """Build one compiled regex over all canned-response phrases.
     
-    # Check for "how are you" variations
-    if any(phrase in message_lower for phrase in ["how are you", "how are u", "how do you do", "how's it going"]):
-        return "I'm doing well, thank you for asking! I'm here and ready to help you with any questions or tasks you have."
+    The alternation sits in a lookahead so every start position is tried, and
+    alternatives are in priority order so each position reports its best phrase.
+    """
+    entries = sorted(_response_entries(), key=lambda item: item[1])
+    groups = {f"g{i}": entry for i, (_, entry) in enumerate(entries)}
+    alternation = "|".join(f"(?P<g{i}>{re.escape(phrase)})" for i, (phrase, _) in enumerate(entries))
+    return re.compile(f"(?=(?:{alternation}))"), groups
+
+if ahocorasick is not None:
+    RESPONSE_AUTOMATON = _build_response_automaton()
+else:
+    RESPONSE_AUTOMATON = None
+    RESPONSE_PATTERN, RESPONSE_GROUPS = _build_response_pattern()
+
+def get_response(message: str, doc_preview: Optional[str] = None):
+    """Get response based on message and a preview of the user's documents"""
+    message_lower = message.lower().strip()
     
-    # Check knowledge base
-    for key, value in KNOWLEDGE_BASE.items():
-        if key in message_lower:
-            return value
+    # Greetings, "how are you" variations and knowledge base in one pass
+    if RESPONSE_AUTOMATON is not None:
+        matches = (entry for _, entry in RESPONSE_AUTOMATON.iter(message_lower))
+    else:
+        matches = (RESPONSE_GROUPS[m.lastgroup] for m in RESPONSE_PATTERN.finditer(message_lower))
+    best = min(matches, default=None)
+    if best is not None:
+        return best[2]
     
     # If user has documents, provide context-aware response
-    if user_documents:
-        doc_content = " ".join(user_documents[:2])  # Use first 2 documents
-        if len(doc_content) > 1000:
-            doc_content = doc_content[:1000] + "..."
-        
-        return f"Based on your uploaded documents, I can see you're asking about '{message}'. Your documents contain information about: {doc_content[:200]}... Would you like me to provide more specific information about this topic?"
+    if doc_preview is not None:
+        return f"Based on your uploaded documents, I can see you're asking about '{message}'. Your documents contain information about: {doc_preview}... Would you like me to provide more specific information about this topic?"
     
     # Default response
     return f"I understand you're asking about '{message}'. That's an interesting topic! Could you provide more details about what specifically you'd like to know?"
@@ -221,6 +386,9 @@ async def login(email: str = Form(...), password: str = Form(...)):
     if not verify_password(password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if needs_rehash(user["password"]):
+        user["password"] = hash_password(password)
+    
     token = create_token(user["user_id"])
     tokens_db[token] = user["user_id"]
     
@@ -248,8 +416,26 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
         
-        # Extract text
-        text = extract_text_from_file(file)
+        # Reject by extension and declared size before reading any bytes
+        declared_size = file.size or 0
+        max_size = file_processor.max_file_size
+        if declared_size > max_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum size is {max_size // (1024*1024)}MB"
+            )
+        # Extensionless uploads are identified by their magic number during extraction
+        if os.path.splitext(file.filename)[1]:
+            is_valid, message = file_processor.validate_file(file.filename, declared_size)
+            if not is_valid:
+                raise HTTPException(status_code=400, detail=message)
+        
+        # Stream to disk, then extract text from the saved file
+        tmp_path = await save_upload_to_tempfile(file, max_size)
+        try:
+            text = extract_text_from_file(tmp_path, file.filename)
+        finally:
+            os.remove(tmp_path)
         
         if len(text) == 0:
             raise HTTPException(status_code=400, detail="Empty file provided")
@@ -257,13 +443,16 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
         print(f"DEBUG: Extracted text length: {len(text)}")
         
         # Store in simple storage
-        content_id = f"content_{int(time.time())}"
+        content_id = f"content_{uuid4().hex}"
         uploaded_content[content_id] = {
             "filename": file.filename,
             "content": text,
+            "size": len(text),
             "user_id": user["user_id"],
             "upload_time": time.time()
         }
+        user_to_content_ids[user["user_id"]].append(content_id)
+        refresh_doc_preview(user["user_id"])
         
         print(f"DEBUG: File uploaded successfully with ID: {content_id}")
         
@@ -275,6 +464,8 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
             "text_length": len(text)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error uploading document: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
@@ -287,14 +478,14 @@ async def list_content(user: dict = Depends(get_current_user)):
         
         # Get user's content
         user_content = []
-        for content_id, content_data in uploaded_content.items():
-            if content_data.get('user_id') == user.get('user_id'):
-                user_content.append({
-                    "id": content_id,
-                    "filename": content_data.get('filename', 'Unknown'),
-                    "size": len(content_data.get('content', '')),
-                    "upload_time": content_data.get('upload_time', 0)
-                })
+        for content_id in user_to_content_ids.get(user.get('user_id'), []):
+            content_data = uploaded_content[content_id]
+            user_content.append({
+                "id": content_id,
+                "filename": content_data.get('filename', 'Unknown'),
+                "size": content_data.get('size', 0),
+                "upload_time": content_data.get('upload_time', 0)
+            })
         
         print(f"DEBUG: Found {len(user_content)} files for user")
         
@@ -325,18 +516,15 @@ async def chat_general(message: str = Form(...)):
 @app.post("/api/chat/rag")
 async def chat_rag(message: str = Form(...), user: dict = Depends(get_current_user)):
     try:
-        # Get user's documents
-        user_documents = []
-        for content_id, content_data in uploaded_content.items():
-            if content_data.get('user_id') == user.get('user_id'):
-                user_documents.append(content_data.get('content', ''))
+        # Get the cached preview of the user's documents
+        doc_preview = user_doc_preview.get(user.get('user_id'))
         
         # Generate response with document context
-        response_text = get_response(message, user_documents)
+        response_text = get_response(message, doc_preview)
         
         return {
             "response": response_text,
-            "source": "documents" if user_documents else "general",
+            "source": "documents" if doc_preview is not None else "general",
             "sources": []
         }
         
@@ -1,28 +1,43 @@
 import os
+import importlib
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import Optional
 import logging
 
-# File processing libraries
-try:
-    import PyPDF2
-except ImportError:
-    PyPDF2 = None
+# PDFs with more pages than this are split across worker processes
+PDF_PARALLEL_MIN_PAGES = 16
+PDF_WORKERS = min(8, os.cpu_count() or 4)
 
-try:
-    from docx import Document
-except ImportError:
-    Document = None
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
 
-try:
-    import pptx
-except ImportError:
-    pptx = None
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Worker processes for large PDFs, started on first use and reused across uploads"""
+    global _pdf_pool
+    if _pdf_pool is None:
+        with _pdf_pool_lock:
+            if _pdf_pool is None:
+                _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return _pdf_pool
 
-try:
-    import pandas as pd
-except ImportError:
-    pd = None
+def shutdown_pdf_pool():
+    """Stop the PDF worker processes; call on application shutdown"""
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(cancel_futures=True)
+
+def _pdf_page_ranges(page_count: int, workers: int) -> list[tuple[int, int]]:
+    """Split page indices into contiguous (start, end) ranges, one per worker"""
+    step = -(-page_count // workers)
+    return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+def _extract_pdf_page_range(file_path: str, start: int, end: int) -> str:
+    """Extract text from a range of PDF pages (runs in a worker process)"""
+    fitz = importlib.import_module("fitz")
+    with fitz.open(file_path) as doc:
+        return "\n".join(doc[i].get_text("text") for i in range(start, end))
 
 class FileProcessor:
     def __init__(self):
@@ -35,6 +50,19 @@ class FileProcessor:
             '.csv': self._extract_csv,
             '.md': self._extract_text
         }
+        self.max_file_size = 10 * 1024 * 1024  # 10MB
+        
+        # File processing libraries are imported on first use (None if missing)
+        self._modules = {}
+    
+    def _load_module(self, name: str):
+        """Import an optional file processing library on first use"""
+        if name not in self._modules:
+            try:
+                self._modules[name] = importlib.import_module(name)
+            except ImportError:
+                self._modules[name] = None
+        return self._modules[name]
     
     def extract_text(self, file_path: str, filename: str) -> str:
         """Extract text from various file formats"""
@@ -68,68 +96,90 @@ class FileProcessor:
     
     def _extract_pdf(self, file_path: str) -> str:
         """Extract text from PDF files"""
-        if PyPDF2 is None:
-            raise Exception("PyPDF2 library not installed. Install with: pip install PyPDF2")
+        fitz = self._load_module("fitz")  # PyMuPDF
+        PyPDF2 = self._load_module("PyPDF2")
+        if fitz is None and PyPDF2 is None:
+            raise Exception("No PDF library installed. Install with: pip install pymupdf")
+        
+        if fitz is not None:
+            try:
+                with fitz.open(file_path) as doc:
+                    page_count = len(doc)
+                    if page_count <= PDF_PARALLEL_MIN_PAGES:
+                        return "\n".join(page.get_text("text") for page in doc).strip()
+                
+                # MuPDF is not thread-safe, so large PDFs are split across processes
+                ranges = _pdf_page_ranges(page_count, PDF_WORKERS)
+                parts = get_pdf_pool().map(
+                    _extract_pdf_page_range,
+                    repeat(file_path),
+                    [start for start, _ in ranges],
+                    [end for _, end in ranges]
+                )
+                return "\n".join(parts).strip()
+            except Exception as e:
+                raise Exception(f"Error reading PDF: {str(e)}")
         
-        text = ""
         try:
             with open(file_path, 'rb') as file:
                 pdf_reader = PyPDF2.PdfReader(file)
-                for page_num in range(len(pdf_reader.pages)):
-                    page = pdf_reader.pages[page_num]
-                    text += page.extract_text() + "\n"
+                return "\n".join(page.extract_text() for page in pdf_reader.pages).strip()
         except Exception as e:
             raise Exception(f"Error reading PDF: {str(e)}")
-        
-        return text.strip()
     
     def _extract_docx(self, file_path: str) -> str:
         """Extract text from DOCX files"""
-        if Document is None:
+        docx = self._load_module("docx")
+        if docx is None:
             raise Exception("python-docx library not installed. Install with: pip install python-docx")
         
         try:
-            doc = Document(file_path)
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
+            doc = docx.Document(file_path)
+            parts: list[str] = [paragraph.text for paragraph in doc.paragraphs]
             
             # Also extract text from tables
             for table in doc.tables:
                 for row in table.rows:
                     for cell in row.cells:
-                        text += cell.text + "\n"
+                        parts.append(cell.text)
         except Exception as e:
             raise Exception(f"Error reading DOCX: {str(e)}")
         
-        return text.strip()
+        return "\n".join(parts).strip()
     
     def _extract_pptx(self, file_path: str) -> str:
         """Extract text from PPTX files"""
+        pptx = self._load_module("pptx")
         if pptx is None:
             raise Exception("python-pptx library not installed. Install with: pip install python-pptx")
         
         try:
             prs = pptx.Presentation(file_path)
-            text = ""
+            parts: list[str] = []
             
             for slide in prs.slides:
                 for shape in slide.shapes:
                     if hasattr(shape, "text"):
-                        text += shape.text + "\n"
+                        parts.append(shape.text)
         except Exception as e:
             raise Exception(f"Error reading PPTX: {str(e)}")
         
-        return text.strip()
+        return "\n".join(parts).strip()
     
     def _extract_csv(self, file_path: str) -> str:
         """Extract text from CSV files"""
+        pd = self._load_module("pandas")
         if pd is None:
             raise Exception("pandas library not installed. Install with: pip install pandas")
         
         try:
-            df = pd.read_csv(file_path)
-            return df.to_string()
+            try:
+                # Arrow's C++ tokenizer; requires pyarrow
+                df = pd.read_csv(file_path, engine="pyarrow", dtype_backend="pyarrow")
+            except Exception:
+                # pyarrow missing, or a file it rejects (e.g. ragged rows)
+                df = pd.read_csv(file_path)
+            return df.to_csv(index=False)
         except Exception as e:
             raise Exception(f"Error reading CSV: {str(e)}")
     
@@ -153,7 +203,7 @@ class FileProcessor:
             return False, f"Unsupported file format: {file_ext}"
         
         # Check file size (limit to 10MB)
-        max_size = 10 * 1024 * 1024  # 10MB
+        max_size = self.max_file_size
         if file_size > max_size:
             return False, f"File too large. Maximum size is {max_size // (1024*1024)}MB"
         
@@ -1,27 +1,62 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import os
+import shutil
+import tempfile
 import logging
 import time
-from typing import List, Optional
+import threading
+import functools
+import heapq
+from collections import Counter, defaultdict, deque
+from itertools import repeat
+from typing import Callable, List, Optional, Union
 import jwt
+import numpy as np
+import orjson
 from datetime import datetime, timedelta
 import hashlib
-import secrets
+import hmac
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from dotenv import load_dotenv
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 import google.generativeai as genai
 import PyPDF2
 import docx
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
 import csv
 import io
-import requests
+from file_processing import (
+    PDF_PARALLEL_MIN_PAGES, PDF_WORKERS, get_pdf_pool, shutdown_pdf_pool,
+    _pdf_page_ranges, _extract_pdf_page_range
+)
+import httpx
 from bs4 import BeautifulSoup
+try:
+    from selectolax.parser import HTMLParser  # lexbor-backed, much faster than bs4
+except ImportError:
+    HTMLParser = None
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
-from langchain_community.vectorstores import Chroma
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import FAISS
+import faiss
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 from langchain.chains import RetrievalQA
 
 # Configure logging
@@ -36,15 +71,35 @@ if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
     gemini_model = genai.GenerativeModel('gemini-1.5-flash')
     llm = ChatGoogleGenerativeAI(model="gemini-pro", google_api_key=GEMINI_API_KEY)
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=GEMINI_API_KEY)
     print("✅ REAL Gemini API configured successfully")
 else:
     print("❌ GEMINI_API_KEY not found")
     gemini_model = None
     llm = None
-    embeddings = None
 
-app = FastAPI(title="NexusAI Chatbot API", version="1.0.0")
+# Embeddings run locally so indexing has no per-chunk API latency or quota;
+# Gemini embeddings are only used if the local model cannot be loaded
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+
+def load_embeddings():
+    try:
+        import torch
+        local_embeddings = HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+            encode_kwargs={"batch_size": 64, "normalize_embeddings": True}
+        )
+        print(f"✅ Local embedding model loaded: {EMBEDDING_MODEL}")
+        return local_embeddings
+    except Exception as e:
+        print(f"⚠️ Local embedding model unavailable: {str(e)}")
+    if GEMINI_API_KEY:
+        return GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=GEMINI_API_KEY)
+    return None
+
+embeddings = load_embeddings()
+
+app = FastAPI(title="NexusAI Chatbot API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -59,32 +114,369 @@ app.add_middleware(
 users_db = {}
 user_documents = {}  # Store user documents
 
+# With REDIS_URL set, users and document metadata live in Redis so they survive
+# restarts and are shared between workers. Document text stays in process
+# (user_documents) to keep Redis small; it only feeds the keyword fallback.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL and aioredis is not None:
+    redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+else:
+    if REDIS_URL:
+        print("⚠️ REDIS_URL is set but the redis package is not installed, using in-memory storage")
+    redis_client = None
+
+# Filter-and-remove runs inside Redis so it is atomic with other workers' rpush/lrem
+_REMOVE_DOCUMENTS_LUA = """
+local key = KEYS[1]
+for _, raw in ipairs(redis.call('LRANGE', key, 0, -1)) do
+    if cjson.decode(raw)['filename'] == ARGV[1] then
+        redis.call('LREM', key, 0, raw)
+    end
+end
+return redis.call('LLEN', key)
+"""
+_remove_documents_script = redis_client.register_script(_REMOVE_DOCUMENTS_LUA) if redis_client is not None else None
+
+async def get_user_record(email: str) -> Optional[dict]:
+    if redis_client is None:
+        return users_db.get(email)
+    return await redis_client.hgetall(f"user:{email}") or None
+
+async def create_user_record(username: str, email: str, hashed_password: str) -> Optional[dict]:
+    """Store a new user, returning None if the email is already registered"""
+    if redis_client is None:
+        if email in users_db:
+            return None
+        user_id = f"user_{len(users_db) + 1}"
+    else:
+        user_id = f"user_{await redis_client.incr('users:next_id')}"
+    
+    record = {
+        "user_id": user_id,
+        "username": username,
+        "email": email,
+        "password": hashed_password
+    }
+    if redis_client is None:
+        users_db[email] = record
+        return record
+    
+    # HSETNX claims the email atomically, so concurrent registrations cannot both win
+    if not await redis_client.hsetnx(f"user:{email}", "user_id", user_id):
+        return None
+    await redis_client.hset(f"user:{email}", mapping=record)
+    return record
+
+async def set_user_password(email: str, hashed_password: str):
+    if redis_client is None:
+        users_db[email]["password"] = hashed_password
+    else:
+        await redis_client.hset(f"user:{email}", "password", hashed_password)
+
+def _document_metadata(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k != 'text_content'}
+
+async def add_document(username: str, doc: dict):
+    user_documents.setdefault(username, []).append(doc)
+    user_term_indexes[username].add(doc)
+    invalidate_answer_cache(username)
+    if redis_client is not None:
+        await redis_client.rpush(f"docs:{username}", orjson.dumps(_document_metadata(doc)))
+
+async def list_documents(username: str) -> List[dict]:
+    if redis_client is None:
+        return [_document_metadata(doc) for doc in user_documents.get(username, [])]
+    return [orjson.loads(raw) for raw in await redis_client.lrange(f"docs:{username}", 0, -1)]
+
+async def has_documents(username: str) -> bool:
+    if redis_client is None:
+        return bool(user_documents.get(username))
+    return await redis_client.llen(f"docs:{username}") > 0
+
+async def remove_documents(username: str, filename: str) -> bool:
+    """Remove every document with this filename; returns whether the user has any left"""
+    if username in user_documents:
+        user_documents[username] = [doc for doc in user_documents[username] if doc["filename"] != filename]
+        user_term_indexes[username].remove(filename)
+    invalidate_answer_cache(username)
+    
+    if redis_client is None:
+        return bool(user_documents.get(username))
+    remaining = await _remove_documents_script(keys=[f"docs:{username}"], args=[filename])
+    return remaining > 0
+
+class TermIndex:
+    """Inverted index over a user's stored documents for the keyword fallback"""
+    def __init__(self):
+        self.postings = defaultdict(set)  # token -> doc keys
+        self.counts = {}  # doc key -> Counter of tokens
+        self.docs = {}  # doc key -> stored document
+        self._next_key = 0
+    
+    def add(self, doc: dict):
+        key = self._next_key
+        self._next_key += 1
+        counts = Counter(doc["text_content"].lower().split())
+        for token in counts:
+            self.postings[token].add(key)
+        self.counts[key] = counts
+        self.docs[key] = doc
+    
+    def remove(self, filename: str):
+        for key in [k for k, doc in self.docs.items() if doc["filename"] == filename]:
+            for token in self.counts.pop(key):
+                keys = self.postings[token]
+                keys.discard(key)
+                if not keys:
+                    del self.postings[token]
+            del self.docs[key]
+    
+    def search(self, query: str, k: int = 3) -> List[dict]:
+        """Return up to k documents ranked by term frequency of the query words"""
+        words = [w for w in set(query.lower().split()) if w in self.postings]
+        if not words:
+            return []
+        candidates = set().union(*(self.postings[w] for w in words))
+        top = heapq.nlargest(k, candidates, key=lambda key: sum(self.counts[key][w] for w in words))
+        return [self.docs[key] for key in top]
+
+user_term_indexes = defaultdict(TermIndex)  # username -> TermIndex
+
+# Per-user FAISS indexes, loaded from disk once and reused across requests
+_vector_stores = {}
+_vector_stores_lock = threading.RLock()
+
+def vector_store_path(username: str) -> str:
+    return f"./faiss_{username}"
+
+# Users with a built index, so the request path never has to stat the filesystem
+_users_with_index = {name[len("faiss_"):] for name in os.listdir(".") if name.startswith("faiss_")}
+
+def get_vector_store(username: str) -> Optional[FAISS]:
+    """Return the user's cached vector store, loading it on first use (None if never indexed)"""
+    vector_store = _vector_stores.get(username)
+    if vector_store is None:
+        with _vector_stores_lock:
+            vector_store = _vector_stores.get(username)
+            if vector_store is None and os.path.exists(vector_store_path(username)):
+                vector_store = FAISS.load_local(vector_store_path(username), embeddings)
+                if isinstance(vector_store.index, faiss.IndexIVF):
+                    vector_store.index.nprobe = IVF_NPROBE
+                _vector_stores[username] = vector_store
+    return vector_store
+
+def drop_vector_store(username: str):
+    """Forget the user's index both in memory and on disk, so deleted vectors can't be reloaded"""
+    with _vector_stores_lock:
+        _vector_stores.pop(username, None)
+        _users_with_index.discard(username)
+        shutil.rmtree(vector_store_path(username), ignore_errors=True)
+
+# Indexes past this size are rebuilt with 8-bit quantized codes; smaller
+# ones stay on an exact flat index
+QUANTIZE_MIN_VECTORS = 5000
+IVF_NLIST = 64
+IVF_NPROBE = 8
+PQ_M = 16
+
+def quantize_if_large(vector_store: FAISS):
+    """Swap a large flat index for an IVF-PQ (or SQ8) index trained on its own vectors"""
+    index = vector_store.index
+    if not isinstance(index, faiss.IndexFlat) or index.ntotal < QUANTIZE_MIN_VECTORS:
+        return
+    
+    vectors = index.reconstruct_n(0, index.ntotal)
+    if index.d % PQ_M == 0:
+        quantizer = faiss.IndexFlatL2(index.d)
+        quantized = faiss.IndexIVFPQ(quantizer, index.d, IVF_NLIST, PQ_M, 8)
+        quantized.nprobe = IVF_NPROBE
+    else:
+        quantized = faiss.IndexScalarQuantizer(index.d, faiss.ScalarQuantizer.QT_8bit)
+    quantized.train(vectors)
+    quantized.add(vectors)  # same order, so index_to_docstore_id stays valid
+    vector_store.index = quantized
+
+# Shared splitter; it holds no per-call state so one instance serves every request
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+def chunk_id(chunk: str) -> str:
+    """Content hash used as the chunk's docstore id, so identical chunks are stored once"""
+    if xxhash is not None:
+        return xxhash.xxh64(chunk.encode()).hexdigest()
+    return hashlib.blake2b(chunk.encode(), digest_size=8).hexdigest()
+
+def _indexed_ids(vector_store: Optional[FAISS]) -> set:
+    return set(vector_store.index_to_docstore_id.values()) if vector_store is not None else set()
+
+def index_chunks(username: str, chunks: List[str]):
+    """Embed chunks not already in the user's index in one call, add them and persist it"""
+    with _vector_stores_lock:
+        indexed = _indexed_ids(get_vector_store(username))
+    new_chunks = {}
+    for chunk in chunks:
+        cid = chunk_id(chunk)
+        if cid not in indexed:
+            new_chunks.setdefault(cid, chunk)
+    
+    if new_chunks:
+        ids = list(new_chunks)
+        texts = list(new_chunks.values())
+        text_embeddings = list(zip(texts, embeddings.embed_documents(texts)))
+        with _vector_stores_lock:
+            vector_store = get_vector_store(username)
+            if vector_store is None:
+                vector_store = FAISS.from_embeddings(text_embeddings, embeddings, ids=ids)
+                _vector_stores[username] = vector_store
+            else:
+                # Re-check under the lock in case a concurrent upload added the same chunks
+                indexed = _indexed_ids(vector_store)
+                fresh = [(cid, pair) for cid, pair in zip(ids, text_embeddings) if cid not in indexed]
+                if fresh:
+                    vector_store.add_embeddings([pair for _, pair in fresh], ids=[cid for cid, _ in fresh])
+            quantize_if_large(vector_store)
+            vector_store.save_local(vector_store_path(username))
+    elif not indexed:
+        return
+    _users_with_index.add(username)
+
+# Semantic answer cache: near-duplicate questions reuse an earlier answer
+# instead of repeating retrieval and the LLM call
+SEMANTIC_CACHE_SIZE = 128
+SEMANTIC_CACHE_TTL = 3600
+SEMANTIC_CACHE_THRESHOLD = 0.9
+
+_query_caches = defaultdict(lambda: deque(maxlen=SEMANTIC_CACHE_SIZE))  # username -> (unit qvec, result, ts)
+
+def _normalize(vector: List[float]) -> np.ndarray:
+    qvec = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(qvec)
+    return qvec / norm if norm else qvec
+
+def lookup_cached_answer(username: str, qvec: np.ndarray) -> Optional[dict]:
+    entries = _query_caches.get(username)
+    if not entries:
+        return None
+    
+    # Entries are appended in time order, so expired ones sit at the left
+    cutoff = time.time() - SEMANTIC_CACHE_TTL
+    while entries and entries[0][2] < cutoff:
+        entries.popleft()
+    if not entries:
+        return None
+    
+    similarities = np.stack([entry[0] for entry in entries]) @ qvec
+    best = int(np.argmax(similarities))
+    if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return entries[best][1]
+    return None
+
+def cache_answer(username: str, qvec: np.ndarray, result: dict):
+    _query_caches[username].append((qvec, result, time.time()))
+
+def invalidate_answer_cache(username: str):
+    _query_caches.pop(username, None)
+
+def _sse(event: dict) -> bytes:
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+def _stream_events(prompt: str, source: str, sources: Optional[int], on_complete: Optional[Callable[[dict], None]]):
+    """Relay Gemini's streamed chunks as SSE frames, ending with a done frame"""
+    parts = []
+    try:
+        for chunk in gemini_model.generate_content(prompt, stream=True):
+            parts.append(chunk.text)
+            yield _sse({"delta": chunk.text})
+    except Exception as e:
+        logging.error(f"Error streaming Gemini response: {str(e)}")
+        yield _sse({"error": str(e), "source": "error"})
+        return
+    
+    result = {"response": "".join(parts), "source": source}
+    if sources is not None:
+        result["sources"] = sources
+    if on_complete:
+        on_complete(result)
+    yield _sse({"done": True, **{k: v for k, v in result.items() if k != "response"}})
+
+def stream_result(result: dict) -> StreamingResponse:
+    """Send an already computed answer using the same SSE framing as a live stream"""
+    def events():
+        yield _sse({"delta": result["response"]})
+        yield _sse({"done": True, **{k: v for k, v in result.items() if k != "response"}})
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def respond(prompt: str, source: str, sources: Optional[int] = None, stream: bool = False,
+            on_complete: Optional[Callable[[dict], None]] = None) -> Union[dict, StreamingResponse]:
+    """Generate an answer with Gemini, either as one JSON body or streamed as SSE"""
+    if stream:
+        # Sync generator: Starlette iterates it in the threadpool, off the event loop
+        return StreamingResponse(_stream_events(prompt, source, sources, on_complete), media_type="text/event-stream")
+    
+    response = gemini_model.generate_content(prompt)
+    result = {"response": response.text, "source": source}
+    if sources is not None:
+        result["sources"] = sources
+    if on_complete:
+        on_complete(result)
+    return result
+
+def answer_from_vector_store(username: str, message: str, stream: bool = False) -> Union[dict, StreamingResponse, None]:
+    """Answer from the user's vector store, reusing cached answers for similar questions"""
+    query_embedding = embeddings.embed_query(message)
+    qvec = _normalize(query_embedding)
+    cached = lookup_cached_answer(username, qvec)
+    if cached is not None:
+        return stream_result(cached) if stream else cached
+    
+    vector_store = get_vector_store(username)
+    if vector_store is None:
+        return None
+    docs = vector_store.similarity_search_by_vector(query_embedding, k=3)
+    if not docs:
+        return None
+    
+    context = "\n".join([doc.page_content for doc in docs])
+    prompt = f"Based on the following context from uploaded documents:\n\n{context}\n\nAnswer this question: {message}"
+    return respond(prompt, "documents", len(docs), stream, lambda result: cache_answer(username, qvec, result))
+
 # Auth functions
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 def hash_password(password: str) -> str:
-    salt = secrets.token_hex(16)
-    password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}:{password_hash}"
+    return _ph.hash(password)
 
 def verify_password(password: str, hashed_password: str) -> bool:
+    if not hashed_password.startswith("$argon2"):
+        # Legacy salt:sha256 hash
+        try:
+            salt, password_hash = hashed_password.split(":")
+            return hmac.compare_digest(hashlib.sha256((password + salt).encode()).hexdigest(), password_hash)
+        except:
+            return False
     try:
-        salt, password_hash = hashed_password.split(":")
-        return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
-    except:
+        return _ph.verify(hashed_password, password)
+    except (VerificationError, InvalidHash):
         return False
 
+def needs_rehash(hashed_password: str) -> bool:
+    if not hashed_password.startswith("$argon2"):
+        return True
+    return _ph.check_needs_rehash(hashed_password)
+
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
+
 def create_token(user_id: str) -> str:
     payload = {
         "user_id": user_id,
         "exp": datetime.utcnow() + timedelta(days=7)
     }
-    secret_key = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
-    token = jwt.encode(payload, secret_key, algorithm="HS256")
+    token = jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")
     print(f"✅ Token created for user: {user_id}")
     return token
 
-def verify_token(token: str) -> Optional[dict]:
+@functools.lru_cache(maxsize=8192)
+def _verify_token_cached(token: str, secret_key: str) -> Optional[dict]:
     try:
-        secret_key = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
         print(f"✅ Token verified for user: {payload.get('user_id')}")
         return payload
@@ -92,11 +484,20 @@ def verify_token(token: str) -> Optional[dict]:
         print(f"❌ Token verification failed: {str(e)}")
         return None
 
+def verify_token(token: str) -> Optional[dict]:
+    payload = _verify_token_cached(token, JWT_SECRET_KEY)
+    # Cached payloads must still honour the token's own expiry
+    if payload is None or payload["exp"] <= time.time():
+        return None
+    return payload
+
 class User:
     def __init__(self, username: str):
         self.username = username
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+security = HTTPBearer()
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = verify_token(token)
     
@@ -105,27 +506,63 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(H
     
     return User(username=payload.get("user_id"))
 
+# Vector indexing progress per user: username -> {filename: status}
+indexing_status = {}
+
+def index_document(username: str, filename: str, text: str):
+    """Split, embed and store a document in the user's vector store (runs as a background task)"""
+    try:
+        chunks = TEXT_SPLITTER.split_text(text)
+        
+        index_chunks(username, chunks)
+        indexing_status[username][filename] = "indexed"
+        invalidate_answer_cache(username)
+        print(f"✅ Vector storage successful for {filename}")
+    except Exception as vector_error:
+        indexing_status[username][filename] = "failed"
+        print(f"⚠️ Vector storage failed (quota exceeded), using simple text storage: {str(vector_error)}")
+
 # Document processing functions
+# The PDF worker pool is shared with file_processing and stopped with the app
+app.on_event("shutdown")(shutdown_pdf_pool)
+
 def extract_text_from_pdf(file: UploadFile):
-    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.file.read()))
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
-    return text.strip()
+    if fitz is not None:
+        # PyMuPDF needs the raw bytes
+        data = file.file.read()
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            page_count = len(doc)
+            if page_count <= PDF_PARALLEL_MIN_PAGES:
+                return "\n".join(page.get_text("text") for page in doc).strip()
+        
+        # MuPDF is not thread-safe, so large PDFs are split across processes,
+        # which open a temporary copy by path rather than each receiving the bytes
+        ranges = _pdf_page_ranges(page_count, PDF_WORKERS)
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            parts = get_pdf_pool().map(
+                _extract_pdf_page_range,
+                repeat(tmp.name),
+                [start for start, _ in ranges],
+                [end for _, end in ranges]
+            )
+            return "\n".join(parts).strip()
+    
+    pdf_reader = PyPDF2.PdfReader(file.file)
+    return "\n".join(page.extract_text() for page in pdf_reader.pages).strip()
 
 def extract_text_from_docx(file: UploadFile):
-    doc = docx.Document(io.BytesIO(file.file.read()))
-    text = ""
-    for paragraph in doc.paragraphs:
-        text += paragraph.text + "\n"
-    return text.strip()
+    doc = docx.Document(file.file)
+    return "\n".join(paragraph.text for paragraph in doc.paragraphs).strip()
 
 def extract_text_from_csv(file: UploadFile):
-    content = file.file.read().decode('utf-8')
-    csv_reader = csv.reader(io.StringIO(content))
-    text = ""
-    for row in csv_reader:
-        text += ", ".join(row) + "\n"
+    # Decode rows straight off the upload stream instead of materialising the whole file
+    stream = io.TextIOWrapper(file.file, encoding='utf-8', newline='')
+    try:
+        text = "\n".join(map(", ".join, csv.reader(stream)))
+    finally:
+        stream.detach()  # leave the upload's file open for FastAPI to close
     return text.strip()
 
 def extract_text_from_file(file: UploadFile):
@@ -146,166 +583,113 @@ async def health_check():
     return {"status": "healthy", "message": "NexusAI Chatbot API is running"}
 
 @app.post("/api/chat/general")
-async def chat_general(message: str = Form(...)):
+async def chat_general(message: str = Form(...), stream: bool = Form(False)):
     try:
         if not gemini_model:
             raise HTTPException(status_code=500, detail="Gemini API not configured")
         
         # Call REAL Gemini API
-        response = gemini_model.generate_content(message)
-        return {"response": response.text, "source": "general"}
+        return respond(message, "general", stream=stream)
     except Exception as e:
         logging.error(f"Error in Gemini API call: {str(e)}")
         return {"response": f"I'm experiencing technical difficulties. Error: {str(e)}", "source": "error"}
 
 # RAG chat endpoint for frontend
 @app.post("/api/chat/rag")
-async def chat_rag(message: str = Form(...), current_user: User = Depends(get_current_user)):
+async def chat_rag(message: str = Form(...), stream: bool = Form(False), current_user: User = Depends(get_current_user)):
     try:
         if not gemini_model:
             raise HTTPException(status_code=500, detail="Gemini API not configured")
 
         # Check if user has documents stored
-        if current_user.username not in user_documents or not user_documents[current_user.username]:
+        if not await has_documents(current_user.username):
             # Fallback to general Gemini if no documents
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
+            return respond(message, "general", stream=stream)
         
         # Try vector search first if available
         try:
             if embeddings:
-                persist_directory = f"./chroma_db_{current_user.username}"
-                if os.path.exists(persist_directory):
-                    vector_store = Chroma(
-                        collection_name=f"user_{current_user.username}",
-                        embedding_function=embeddings,
-                        persist_directory=persist_directory
-                    )
-                    
-                    retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-                    docs = retriever.get_relevant_documents(message)
-                    
-                    if docs:
-                        context = "\n".join([doc.page_content for doc in docs])
-                        prompt = f"Based on the following context from uploaded documents:\n\n{context}\n\nAnswer this question: {message}"
-                        response = gemini_model.generate_content(prompt)
-                        return {"response": response.text, "source": "documents", "sources": len(docs)}
+                if current_user.username in _users_with_index:
+                    result = answer_from_vector_store(current_user.username, message, stream)
+                    if result:
+                        return result
         except Exception as vector_error:
             print(f"⚠️ Vector search failed, using simple text search: {str(vector_error)}")
         
-        # Fallback to simple text search in stored documents
-        user_docs = user_documents[current_user.username]
-        relevant_content = []
-        
-        for doc in user_docs:
-            if 'text_content' in doc:
-                text_content = doc['text_content'].lower()
-                message_lower = message.lower()
-                
-                # Simple keyword matching
-                if any(word in text_content for word in message_lower.split()):
-                    relevant_content.append(doc['text_content'])
+        # Fallback to keyword search over the user's inverted index
+        relevant_content = [doc['text_content'] for doc in user_term_indexes[current_user.username].search(message, k=3)]
         
         if relevant_content:
-            context = "\n\n".join(relevant_content[:3])  # Limit to 3 most relevant
+            context = "\n\n".join(relevant_content)
             prompt = f"Based on the following context from uploaded documents:\n\n{context}\n\nAnswer this question: {message}"
-            response = gemini_model.generate_content(prompt)
-            return {"response": response.text, "source": "documents", "sources": len(relevant_content)}
+            return respond(prompt, "documents", len(relevant_content), stream)
         else:
             # Fallback to general Gemini if no relevant content found
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
+            return respond(message, "general", stream=stream)
             
     except Exception as e:
         logging.error(f"Error in RAG query: {str(e)}")
         # Fallback to general Gemini on RAG error
         if gemini_model:
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
+            return respond(message, "general", stream=stream)
         else:
             return {"response": f"Could not query documents: {str(e)}", "source": "error"}
 
 @app.post("/api/upload")
-async def upload_document(file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
+async def upload_document(background_tasks: BackgroundTasks, file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
     try:
-        # Extract text from file
-        text = extract_text_from_file(file)
-        
-        # Store document info and text content
-        if current_user.username not in user_documents:
-            user_documents[current_user.username] = []
+        # Extract text from file (off the event loop; large PDFs wait on worker processes)
+        text = await run_in_threadpool(extract_text_from_file, file)
         
         # Store document with full text content for simple RAG
-        user_documents[current_user.username].append({
+        await add_document(current_user.username, {
             "filename": file.filename,
             "text_content": text,  # Store full text for simple search
             "text_length": len(text),
-            "upload_time": datetime.now().isoformat()
+            "upload_time": datetime.now()  # orjson serialises datetimes natively
         })
         
-        # Try vector storage if embeddings are available, but don't fail if quota exceeded
-        try:
-            if embeddings:
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                chunks = text_splitter.split_text(text)
-                
-                vector_store = Chroma.from_texts(
-                    texts=chunks, 
-                    embedding=embeddings,
-                    collection_name=f"user_{current_user.username}",
-                    persist_directory=f"./chroma_db_{current_user.username}"
-                )
-                vector_store.persist()
-                print(f"✅ Vector storage successful for {file.filename}")
-        except Exception as vector_error:
-            print(f"⚠️ Vector storage failed (quota exceeded), using simple text storage: {str(vector_error)}")
+        # Vector storage runs after the response is sent; simple text search works meanwhile
+        if embeddings:
+            indexing_status.setdefault(current_user.username, {})[file.filename] = "processing"
+            background_tasks.add_task(index_document, current_user.username, file.filename, text)
+            return {"status": "processing", "message": "Document received, indexing in background", "filename": file.filename, "text_length": len(text)}
         
         return {"status": "success", "message": "Document processed successfully", "filename": file.filename, "text_length": len(text)}
     except Exception as e:
         logging.error(f"Error uploading document: {str(e)}")
         return {"status": "error", "message": f"Upload failed: {str(e)}"}
 
+@app.get("/api/upload/status/{filename}")
+async def upload_status(filename: str, current_user: User = Depends(get_current_user)):
+    status = indexing_status.get(current_user.username, {}).get(filename)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No indexing job for this file")
+    return {"filename": filename, "status": status}
+
 @app.post("/api/query-documents")
-async def query_documents(message: str = Form(...), current_user: User = Depends(get_current_user)):
+async def query_documents(message: str = Form(...), stream: bool = Form(False), current_user: User = Depends(get_current_user)):
     try:
         if not llm or not embeddings:
             raise HTTPException(status_code=500, detail="Gemini API or Embeddings not configured")
 
         # Check if user has documents
-        persist_directory = f"./chroma_db_{current_user.username}"
-        collection_name = f"user_{current_user.username}"
-
-        if not os.path.exists(persist_directory):
+        if current_user.username not in _users_with_index:
             # Fallback to general Gemini if no documents
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
-        
-        vector_store = Chroma(
-            collection_name=collection_name,
-            embedding_function=embeddings,
-            persist_directory=persist_directory
-        )
+            return respond(message, "general", stream=stream)
         
-        retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-        docs = retriever.get_relevant_documents(message)
+        result = answer_from_vector_store(current_user.username, message, stream)
         
-        if not docs:
+        if not result:
             # Fallback to general Gemini if no relevant documents
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
-        
-        context = "\n".join([doc.page_content for doc in docs])
-        prompt = f"Based on the following context from uploaded documents:\n\n{context}\n\nAnswer this question: {message}"
+            return respond(message, "general", stream=stream)
         
-        response = gemini_model.generate_content(prompt)
-        
-        return {"response": response.text, "source": "documents", "sources": len(docs)}
+        return result
     except Exception as e:
         logging.error(f"Error in RAG query: {str(e)}")
         # Fallback to general Gemini on RAG error
         if gemini_model:
-            response = gemini_model.generate_content(message)
-            return {"response": response.text, "source": "general"}
+            return respond(message, "general", stream=stream)
         else:
             return {"response": f"Could not query documents: {str(e)}", "source": "error"}
 
@@ -314,15 +698,8 @@ async def query_documents(message: str = Form(...), current_user: User = Depends
 async def list_content(current_user: User = Depends(get_current_user)):
     try:
         print(f"✅ Content list requested by user: {current_user.username}")
-        if current_user.username not in user_documents:
-            return {"content": []}
-        
-        documents = user_documents[current_user.username]
-        # Remove text_content from response to reduce payload size
-        response_docs = []
-        for doc in documents:
-            response_doc = {k: v for k, v in doc.items() if k != 'text_content'}
-            response_docs.append(response_doc)
+        # Metadata only; text_content is never sent to keep the payload small
+        response_docs = await list_documents(current_user.username)
         
         print(f"✅ Returning {len(response_docs)} documents for user: {current_user.username}")
         return {"content": response_docs}
@@ -333,39 +710,53 @@ async def list_content(current_user: User = Depends(get_current_user)):
 @app.delete("/api/content/{filename}")
 async def delete_content(filename: str, current_user: User = Depends(get_current_user)):
     try:
-        if current_user.username in user_documents:
-            user_documents[current_user.username] = [
-                doc for doc in user_documents[current_user.username] 
-                if doc["filename"] != filename
-            ]
+        # Remove the vector store once the user has no documents left
+        if not await remove_documents(current_user.username, filename):
+            await run_in_threadpool(drop_vector_store, current_user.username)
         
         return {"status": "success", "message": f"Document {filename} deleted"}
     except Exception as e:
         logging.error(f"Error deleting content: {str(e)}")
         return {"status": "error", "message": f"Delete failed: {str(e)}"}
 
-def extract_content_from_url(url: str):
+# Shared async HTTP client so URL fetches reuse pooled connections without blocking the event loop
+_http = httpx.AsyncClient(
+    timeout=10,
+    follow_redirects=True,
+    headers={
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await _http.aclose()
+
+async def extract_content_from_url(url: str):
     """Extract text content from a URL"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
+        response = await _http.get(url)
         response.raise_for_status()
         
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
-        
-        # Get text content
-        text = soup.get_text()
+        if HTMLParser is not None:
+            tree = HTMLParser(response.content)
+            
+            # Remove script and style elements
+            tree.strip_tags(["script", "style"])
+            
+            root = tree.body or tree.root
+            text = root.text(separator=" ", strip=True) if root is not None else ""
+        else:
+            soup = BeautifulSoup(response.content, 'html.parser')
+            
+            # Remove script and style elements
+            for script in soup(["script", "style"]):
+                script.decompose()
+            
+            text = soup.get_text(separator=" ")
         
-        # Clean up text
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = ' '.join(chunk for chunk in chunks if chunk)
+        # Collapse whitespace runs left between and inside text nodes
+        text = " ".join(text.split())
         
         return text[:10000]  # Limit to 10k characters
     except Exception as e:
@@ -375,34 +766,23 @@ def extract_content_from_url(url: str):
 async def add_url_content(url: str = Form(...), current_user: User = Depends(get_current_user)):
     try:
         # Extract content from URL
-        text_content = extract_content_from_url(url)
-        
-        # Store document info and text content
-        if current_user.username not in user_documents:
-            user_documents[current_user.username] = []
+        text_content = await extract_content_from_url(url)
         
         # Store document with full text content for simple RAG
-        user_documents[current_user.username].append({
+        await add_document(current_user.username, {
             "filename": f"URL: {url}",
             "text_content": text_content,  # Store full text for simple search
             "text_length": len(text_content),
-            "upload_time": datetime.now().isoformat(),
+            "upload_time": datetime.now(),
             "url": url
         })
         
         # Try vector storage if embeddings are available, but don't fail if quota exceeded
         try:
             if embeddings:
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                chunks = text_splitter.split_text(text_content)
+                chunks = TEXT_SPLITTER.split_text(text_content)
                 
-                vector_store = Chroma.from_texts(
-                    texts=chunks, 
-                    embedding=embeddings,
-                    collection_name=f"user_{current_user.username}",
-                    persist_directory=f"./chroma_db_{current_user.username}"
-                )
-                vector_store.persist()
+                index_chunks(current_user.username, chunks)
                 print(f"✅ Vector storage successful for URL: {url}")
         except Exception as vector_error:
             print(f"⚠️ Vector storage failed (quota exceeded), using simple text storage: {str(vector_error)}")
@@ -416,20 +796,12 @@ async def add_url_content(url: str = Form(...), current_user: User = Depends(get
 async def register(username: str = Form(...), email: str = Form(...), password: str = Form(...)):
     print(f"🔐 Registration attempt for: {username} ({email})")
     
-    if email in users_db:
+    user_data = await create_user_record(username, email, hash_password(password))
+    if user_data is None:
         print(f"❌ User already exists: {email}")
         raise HTTPException(status_code=400, detail="User already exists")
     
-    user_id = f"user_{len(users_db) + 1}"
-    hashed_password = hash_password(password)
-    
-    users_db[email] = {
-        "user_id": user_id,
-        "username": username,
-        "email": email,
-        "password": hashed_password
-    }
-    
+    user_id = user_data["user_id"]
     token = create_token(user_id)
     print(f"✅ User registered successfully: {username} with token: {token[:30]}...")
     
@@ -447,15 +819,18 @@ async def register(username: str = Form(...), email: str = Form(...), password:
 async def login(email: str = Form(...), password: str = Form(...)):
     print(f"🔐 Login attempt for: {email}")
     
-    if email not in users_db:
+    user_data = await get_user_record(email)
+    if user_data is None:
         print(f"❌ User not found: {email}")
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    user_data = users_db[email]
     if not verify_password(password, user_data["password"]):
         print(f"❌ Invalid password for: {email}")
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if needs_rehash(user_data["password"]):
+        await set_user_password(email, hash_password(password))
+    
     token = create_token(user_data["user_id"])
     print(f"✅ User logged in successfully: {user_data['username']} with token: {token[:30]}...")
     
@@ -470,4 +845,15 @@ async def login(email: str = Form(...), password: str = Form(...)):
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Users and document metadata can be shared through Redis, but document
+    # text and the vector/keyword indexes are cached per process, so extra
+    # workers are opt-in
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
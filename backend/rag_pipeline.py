@@ -1,8 +1,11 @@
 import os
+import hashlib
 import google.generativeai as genai
-from chromadb import Client, Settings
+import chromadb
+from chromadb import Settings
 from chromadb.config import Settings as ChromaSettings
 import uuid
+from collections import OrderedDict, defaultdict
 from typing import List, Dict, Tuple, Optional
 import logging
 import numpy as np
@@ -15,73 +18,419 @@ except ImportError:
     SENTENCE_TRANSFORMERS_AVAILABLE = False
     SentenceTransformer = None
 
+# Numba is optional; without it chunk_text keeps using str.rfind
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# usearch is optional; without it candidate search uses QuantizedIndex
+try:
+    from usearch.index import Index as UsearchIndex
+except ImportError:
+    UsearchIndex = None
+
+# tiktoken is optional; without it the context budget is counted in characters
+try:
+    import tiktoken
+    _TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _TOKEN_ENCODING = None
+
+logger = logging.getLogger(__name__)
+
+_PERIOD = ord('.')
+_SPACE = ord(' ')
+
+def _chunk_offsets(buf: np.ndarray, chunk_size: int, chunk_overlap: int) -> np.ndarray:
+    """Return (start, end) pairs for overlapping chunks of a code point array
+    
+    Same boundary rules as RAGPipeline.chunk_text: prefer ending after a
+    period, then at a space, as long as the chunk stays over half full.
+    """
+    n = len(buf)
+    starts = []
+    ends = []
+    start = 0
+    while start < n:
+        end = start + chunk_size
+        if end < n:
+            boundary = -1
+            for i in range(end - 1, start - 1, -1):
+                if buf[i] == _PERIOD:
+                    boundary = i
+                    break
+            if boundary > start + chunk_size // 2:
+                end = boundary + 1
+            else:
+                boundary = -1
+                for i in range(end - 1, start - 1, -1):
+                    if buf[i] == _SPACE:
+                        boundary = i
+                        break
+                if boundary > start + chunk_size // 2:
+                    end = boundary
+        starts.append(start)
+        ends.append(end)
+        start = end - chunk_overlap
+        if start >= n:
+            break
+    offsets = np.empty((len(starts), 2), dtype=np.int64)
+    for i in range(len(starts)):
+        offsets[i, 0] = starts[i]
+        offsets[i, 1] = ends[i]
+    return offsets
+
+_chunk_offsets_jit = njit(cache=True)(_chunk_offsets) if njit is not None else None
+
+class BatchIngester:
+    """Buffer chunk records for one collection and write them with bulk add() calls
+    
+    on_written is called with the ids, embeddings and metadatas of each batch
+    once it is stored; on_dropped with the ids and metadatas of records
+    discarded after a failed write.
+    """
+    
+    def __init__(self, collection, batch_size: int = 250, on_written=None, on_dropped=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.on_written = on_written
+        self.on_dropped = on_dropped
+        self.ids = []
+        self.embeddings = []
+        self.documents = []
+        self.metadatas = []
+    
+    def add(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict]) -> Dict[str, Exception]:
+        """Queue records, flushing once a full batch is buffered
+        
+        Returns the documents dropped by that flush, as flush() does.
+        """
+        self.ids.extend(ids)
+        self.embeddings.append(np.asarray(embeddings, dtype=np.float32))
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        if len(self.ids) >= self.batch_size:
+            return self.flush()
+        return {}
+    
+    def flush(self) -> Dict[str, Exception]:
+        """Write all buffered records, batch_size per add() (one SQLite transaction each)
+        
+        If a batch fails, every document with a record in it is dropped: its
+        unwritten records are discarded and those already written by earlier
+        batches are deleted again. The other documents are still written.
+        Returns content_id -> error for each dropped document, so a failure is
+        reported against its own document rather than whichever call flushed.
+        """
+        if not self.ids:
+            return {}
+        # Take the buffer up front so failed records can never be flushed again
+        ids, documents, metadatas = self.ids, self.documents, self.metadatas
+        rows = [row for block in self.embeddings for row in block]  # views; blocks may differ in width
+        self.ids, self.embeddings, self.documents, self.metadatas = [], [], [], []
+        
+        failed = {}  # content_id -> error, for dropped documents
+        written = []  # positions of stored records
+        for start in range(0, len(ids), self.batch_size):
+            batch = [i for i in range(start, min(start + self.batch_size, len(ids)))
+                     if metadatas[i].get("content_id") not in failed]
+            if not batch:
+                continue
+            try:
+                self.collection.add(
+                    ids=[ids[i] for i in batch],
+                    embeddings=np.stack([rows[i] for i in batch]).tolist(),  # chromadb 0.4 only accepts nested lists
+                    documents=[documents[i] for i in batch],
+                    metadatas=[metadatas[i] for i in batch]
+                )
+            except Exception as e:
+                logging.error(f"Dropping {len(batch)} buffered chunks after failed write: {str(e)}")
+                for i in batch:
+                    failed.setdefault(metadatas[i].get("content_id"), e)
+                continue
+            written.extend(batch)
+            if self.on_written:
+                self.on_written(
+                    [ids[i] for i in batch],
+                    np.stack([rows[i] for i in batch]),
+                    [metadatas[i] for i in batch]
+                )
+        
+        if not failed:
+            return failed
+        stale = [ids[i] for i in written if metadatas[i].get("content_id") in failed]
+        if stale:
+            try:
+                self.collection.delete(ids=stale)
+            except Exception as e:
+                logging.error(f"Could not roll back {len(stale)} chunks of failed documents: {str(e)}")
+        if self.on_dropped:
+            dropped = [i for i in range(len(ids)) if metadatas[i].get("content_id") in failed]
+            self.on_dropped([ids[i] for i in dropped], [metadatas[i] for i in dropped])
+        return failed
+    
+    def close(self) -> Dict[str, Exception]:
+        return self.flush()
+
+# Set-bit count for every byte value, for Hamming distance over packed bits
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class QuantizedIndex:
+    """Quantized codes of a user's embeddings for candidate search
+    
+    Two codes are kept per vector: one bit per dimension (above or below the
+    dimension's mean), packed so a 384-d vector is 48 bytes, and int8 codes
+    mapping each dimension's [min, max] range onto 256 levels. Search narrows
+    by Hamming distance on the bits, then ranks the survivors on the int8
+    codes; the caller does the final ranking on fp32 embeddings.
+    
+    The codes are held in memory in addition to the fp32 vectors Chroma
+    stores, so they make the scan cheaper rather than saving memory. The mean
+    and ranges are fixed when the index is built; vectors added later are
+    clipped to them, and the fp32 rerank corrects the final order.
+    """
+    
+    def __init__(self, ids: List[str], embeddings: np.ndarray):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.ids = []
+        self.center = matrix.mean(axis=0)
+        self.low = matrix.min(axis=0)
+        self.scale = np.maximum(matrix.max(axis=0) - self.low, 1e-12) / 255.0
+        self.bits = np.empty((0, (matrix.shape[1] + 7) // 8), dtype=np.uint8)
+        self.codes = np.empty((0, matrix.shape[1]), dtype=np.int8)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.add(ids, matrix)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def add(self, ids: List[str], embeddings: np.ndarray):
+        """Append codes for newly stored vectors"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        codes = np.clip(np.round((matrix - self.low) / self.scale) - 128, -128, 127).astype(np.int8)
+        self.bits = np.concatenate([self.bits, np.packbits(matrix > self.center, axis=1)])
+        self.codes = np.concatenate([self.codes, codes])
+        # Norms of the dequantized vectors, for cosine scoring
+        self.norms = np.concatenate([self.norms, np.linalg.norm(self._dequantize(codes), axis=1)])
+        self.ids.extend(ids)
+    
+    def remove(self, ids: List[str]):
+        """Drop the codes of deleted vectors; unknown ids are ignored"""
+        removed = set(ids)
+        keep = np.fromiter((chunk_id not in removed for chunk_id in self.ids), dtype=bool, count=len(self.ids))
+        if keep.all():
+            return
+        self.ids = [chunk_id for chunk_id, kept in zip(self.ids, keep) if kept]
+        self.bits, self.codes, self.norms = self.bits[keep], self.codes[keep], self.norms[keep]
+    
+    def _dequantize(self, codes: np.ndarray) -> np.ndarray:
+        return (codes.astype(np.float32) + 128) * self.scale + self.low
+    
+    def _hamming_candidates(self, query: np.ndarray, k: int) -> np.ndarray:
+        query_bits = np.packbits(query > self.center)
+        distances = _POPCOUNT[self.bits ^ query_bits].sum(axis=1, dtype=np.int32)
+        return np.argpartition(distances, k - 1)[:k]
+    
+    def search(self, query: np.ndarray, k: int, coarse_k: Optional[int] = None) -> List[str]:
+        """Return ids of the k best candidates by approximate cosine similarity
+        
+        When coarse_k is given and smaller than the index, only the coarse_k
+        nearest vectors by Hamming distance are scored on the int8 codes.
+        """
+        if coarse_k is not None and coarse_k < len(self.ids):
+            rows = self._hamming_candidates(query, coarse_k)
+        else:
+            rows = np.arange(len(self.ids))
+        
+        # q . x = q . low + (q * scale) . (code + 128), without materialising x
+        scores = (self.codes[rows].astype(np.float32) + 128) @ (query * self.scale) + float(query @ self.low)
+        scores /= np.maximum(self.norms[rows], 1e-12)
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [self.ids[rows[i]] for i in top[np.argsort(-scores[top])]]
+
+class HNSWIndex:
+    """In-process usearch HNSW graph over int8-quantized embeddings
+    
+    Same add()/remove()/search() contract as QuantizedIndex, but candidates
+    come from a graph walk instead of a scan over every vector.
+    """
+    
+    def __init__(self, ids: List[str], embeddings: np.ndarray):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.graph = UsearchIndex(ndim=matrix.shape[1], metric='cos', dtype='i8')
+        self._ids = {}  # graph key -> chunk id
+        self._keys = {}  # chunk id -> graph key
+        self._next_key = 0
+        self.add(ids, matrix)
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def add(self, ids: List[str], embeddings: np.ndarray):
+        """Insert newly stored vectors into the graph"""
+        keys = np.arange(self._next_key, self._next_key + len(ids), dtype=np.uint64)
+        self._next_key += len(ids)
+        self.graph.add(keys, np.asarray(embeddings, dtype=np.float32))
+        for key, chunk_id in zip(keys.tolist(), ids):
+            self._ids[key] = chunk_id
+            self._keys[chunk_id] = key
+    
+    def remove(self, ids: List[str]):
+        """Remove deleted vectors from the graph; unknown ids are ignored"""
+        keys = [self._keys.pop(chunk_id) for chunk_id in ids if chunk_id in self._keys]
+        if keys:
+            self.graph.remove(np.array(keys, dtype=np.uint64))
+            for key in keys:
+                del self._ids[key]
+    
+    def search(self, query: np.ndarray, k: int, coarse_k: Optional[int] = None) -> List[str]:
+        """Return ids of the k best candidates by approximate cosine similarity"""
+        matches = self.graph.search(query, min(k, len(self)))
+        return [self._ids[key] for key in matches.keys]
+
 class RAGPipeline:
     def __init__(self):
         # Initialize Gemini API
+        # Without a key, embeddings come from the fallback models and chat is unavailable
         self.gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not self.gemini_api_key:
-            raise ValueError("GEMINI_API_KEY environment variable is required")
-        
-        genai.configure(api_key=self.gemini_api_key)
-        self.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+        if self.gemini_api_key:
+            genai.configure(api_key=self.gemini_api_key)
+            self.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+        else:
+            logging.warning("GEMINI_API_KEY not set; using fallback embeddings and no chat model")
+            self.gemini_model = None
         
         # Initialize ChromaDB
-        self.chroma_client = Client(Settings(
-            persist_directory="./chroma_db",
-            anonymized_telemetry=False
-        ))
+        self.chroma_client = chromadb.PersistentClient(
+            path="./chroma_db",
+            settings=Settings(anonymized_telemetry=False)
+        )
         
-        # Initialize embedding model (fallback to sentence-transformers if needed)
-        try:
-            self.embedding_model = genai.embed_content
-            self.use_fallback_embeddings = False
-        except:
-            # Fallback to sentence-transformers
-            if SENTENCE_TRANSFORMERS_AVAILABLE:
-                try:
-                    self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-                    self.use_fallback_embeddings = True
-                except:
-                    # If sentence-transformers fails, use a simple fallback
-                    self.embedding_model = None
-                    self.use_fallback_embeddings = False
-                    print("Warning: No embedding model available. RAG functionality will be limited.")
-            else:
-                # If sentence-transformers is not available, use a simple fallback
-                self.embedding_model = None
-                self.use_fallback_embeddings = False
-                print("Warning: No embedding model available. RAG functionality will be limited.")
+        # HNSW knobs: lower construction_ef for write-heavy ingestion, raise
+        # search_ef for read-heavy deployments
+        self.hnsw_metadata = {
+            "hnsw:space": "cosine",
+            "hnsw:construction_ef": int(os.getenv("CHROMA_HNSW_CONSTRUCTION_EF", "100")),
+            "hnsw:M": int(os.getenv("CHROMA_HNSW_M", "16")),
+            "hnsw:search_ef": int(os.getenv("CHROMA_HNSW_SEARCH_EF", "64"))
+        }
+        
+        # One shared collection for all users; chunks carry user_id in metadata
+        self.collection = self.chroma_client.get_or_create_collection(
+            name="documents",
+            metadata=self.hnsw_metadata
+        )
+        
+        # Gemini embeddings whenever a key is configured; the sentence-transformer
+        # fallback is only loaded on first use (see embedding_model)
+        self.use_fallback_embeddings = not self.gemini_api_key
+        self.embedding_device = None
+        self._st_model = None
+        self._st_load_attempted = False
         
         self.chunk_size = 1000
         self.chunk_overlap = 200
+        if _chunk_offsets_jit is not None:
+            # Compile now so the first upload doesn't pay the JIT cost
+            _chunk_offsets_jit(np.zeros(2, dtype=np.uint32), self.chunk_size, self.chunk_overlap)
+        self.embed_batch_size = 100  # Gemini batch embedding accepts up to 100 texts per request
+        self.ingest_batch_size = 250
+        self._ingester = BatchIngester(
+            self.collection,
+            self.ingest_batch_size,
+            on_written=self._record_written,
+            on_dropped=self._forget_dropped
+        )
+        # Candidate search ahead of the fp32 rerank: "hnsw" (usearch graph) or "quantized" (bit + int8 scan)
+        self.candidate_index = os.getenv("RAG_CANDIDATE_INDEX", "hnsw" if UsearchIndex is not None else "quantized")
+        if self.candidate_index == "hnsw" and UsearchIndex is None:
+            logging.warning("RAG_CANDIDATE_INDEX=hnsw needs usearch; using the quantized index")
+            self.candidate_index = "quantized"
+        self._quantized_indexes = {}  # user_id -> HNSWIndex/QuantizedIndex, built on first search, then kept in step with writes
+        self._doc_chunk_counts = {}  # (user_id, content_id) -> total_chunks, for id-based deletes
+        self._content_hashes = {}  # (user_id, content_hash) -> content_id, for fully stored documents
+        self._doc_hashes = {}  # (user_id, content_id) -> content_hash
+        self._pending_hashes = {}  # (user_id, content_hash) -> content_id, for still-buffered documents
+        self._write_failures = {}  # content_id -> error, for buffered documents dropped since the last flush()
+        # Per-instance LRU of query embeddings; repeated questions skip the embedding call
+        self._query_cache = OrderedDict()  # query -> read-only embedding
+        self.query_cache_size = 4096
+        self.rescore_oversample = 4  # int8 candidates per result, reranked on fp32
+        self.binary_oversample = 10  # Hamming candidates per result, scored on int8 (quantized index only)
+        
+        self._migrate_user_collections()
     
-    def create_user_collection(self, user_id: str) -> str:
-        """Create a new collection for a user"""
-        try:
-            collection_name = f"user_{user_id}"
-            collection = self.chroma_client.create_collection(
-                name=collection_name,
-                metadata={"user_id": user_id}
-            )
-            return collection_name
-        except Exception as e:
-            logging.error(f"Error creating collection for user {user_id}: {str(e)}")
-            raise
+    @property
+    def embedding_model(self):
+        """Embedding backend; None when neither Gemini nor a sentence-transformer is usable"""
+        if not self.use_fallback_embeddings:
+            return genai.embed_content
+        if not self._st_load_attempted:
+            self._st_load_attempted = True
+            if SENTENCE_TRANSFORMERS_AVAILABLE:
+                try:
+                    self._st_model = self._load_sentence_transformer('all-MiniLM-L6-v2')
+                except Exception as e:
+                    logging.warning(f"Could not load sentence-transformer: {str(e)}")
+            if self._st_model is None:
+                print("Warning: No embedding model available. RAG functionality will be limited.")
+        return self._st_model
     
-    def get_user_collection(self, user_id: str):
-        """Get user's collection"""
+    def _load_sentence_transformer(self, model_name: str):
+        """Load a sentence-transformer, in half precision when a CUDA device is available"""
+        model = SentenceTransformer(model_name)
+        model.max_seq_length = 256  # chunks are ~1000 chars; caps padding cost
         try:
-            collection_name = f"user_{user_id}"
-            return self.chroma_client.get_collection(name=collection_name)
+            import torch
+            if torch.cuda.is_available():
+                model = model.half().to('cuda')
+                self.embedding_device = 'cuda'
         except Exception as e:
-            logging.error(f"Error getting collection for user {user_id}: {str(e)}")
-            raise
+            # fp16 only pays off on GPU; stay in fp32 on CPU
+            logging.warning(f"Keeping sentence-transformer in fp32: {str(e)}")
+        return model
+    
+    def _migrate_user_collections(self):
+        """Move chunks from legacy per-user user_* collections into the shared collection"""
+        for listed in self.chroma_client.list_collections():
+            name = getattr(listed, "name", listed)
+            if not name.startswith("user_"):
+                continue
+            try:
+                legacy = self.chroma_client.get_collection(name=name)
+                user_id = (legacy.metadata or {}).get("user_id", name[len("user_"):])
+                stored = legacy.get(include=["embeddings", "documents", "metadatas"])
+                if stored['ids']:
+                    metadatas = [{**metadata, "user_id": user_id} for metadata in stored['metadatas']]
+                    failures = self._ingester.add(stored['ids'], stored['embeddings'], stored['documents'], metadatas)
+                    failures.update(self._ingester.flush())
+                    if failures:
+                        raise next(iter(failures.values()))
+                self.chroma_client.delete_collection(name=name)
+                logging.info(f"Migrated {len(stored['ids'])} chunks from collection {name}")
+            except Exception as e:
+                logging.error(f"Error migrating collection {name}: {str(e)}")
+    
+    @staticmethod
+    def _user_filter(user_id: str, **conditions) -> Dict:
+        """Build a where filter restricting a query to one user's chunks"""
+        if not conditions:
+            return {"user_id": user_id}
+        return {"$and": [{"user_id": user_id}] + [{key: value} for key, value in conditions.items()]}
     
     def chunk_text(self, text: str) -> List[str]:
         """Split text into overlapping chunks"""
         if len(text) <= self.chunk_size:
             return [text]
         
+        if _chunk_offsets_jit is not None:
+            # One element per code point, so offsets index the str directly
+            buf = np.frombuffer(text.encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32)
+            offsets = _chunk_offsets_jit(buf, self.chunk_size, self.chunk_overlap)
+            return [chunk for chunk in (text[start:end].strip() for start, end in offsets) if chunk]
+        
         chunks = []
         start = 0
         
@@ -110,60 +459,132 @@ class RAGPipeline:
         
         return chunks
     
-    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for texts with quota handling"""
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Generate a float32 (len(texts), dim) embedding matrix with quota handling"""
+        return self._generate_embeddings(texts)[0]
+    
+    def _generate_embeddings(self, texts: List[str]) -> Tuple[np.ndarray, bool]:
+        """generate_embeddings, also reporting whether an error forced the hash fallback"""
         try:
             if self.embedding_model is None:
                 # Simple fallback: return hash-based embeddings
-                return self._generate_hash_embeddings(texts)
+                return self._generate_hash_embeddings(texts), False
             elif hasattr(self, 'use_fallback_embeddings') and self.use_fallback_embeddings:
-                # Use sentence-transformers
-                embeddings = self.embedding_model.encode(texts)
-                return embeddings.tolist()
+                # Use sentence-transformers; encode() already sorts texts by length
+                # internally so each batch pads only to similar-length neighbours
+                embeddings = self.embedding_model.encode(
+                    texts,
+                    batch_size=32,
+                    device=self.embedding_device,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                return np.ascontiguousarray(embeddings, dtype=np.float32), False
             else:
-                # Use Gemini embeddings with quota handling
+                # Use Gemini embeddings with quota handling, one request per batch of texts
                 embeddings = []
-                for text in texts:
+                degraded = False
+                for batch in self._batch(texts, self.embed_batch_size):
                     try:
                         result = genai.embed_content(
                             model="models/embedding-001",
-                            content=text,
+                            content=batch,
                             task_type="retrieval_document"
                         )
-                        embeddings.append(result['embedding'])
+                        embeddings.extend(result['embedding'])
                     except Exception as e:
                         if "quota" in str(e).lower() or "429" in str(e):
                             logging.warning(f"Gemini quota exceeded, using fallback embeddings: {str(e)}")
                             # Use hash-based embeddings as fallback
-                            embeddings.append(self._generate_hash_embeddings([text])[0])
+                            embeddings.extend(self._generate_hash_embeddings(batch))
+                            degraded = True
                         else:
                             raise e
-                return embeddings
+                return np.asarray(embeddings, dtype=np.float32), degraded
         except Exception as e:
             logging.error(f"Error generating embeddings: {str(e)}")
             # Fallback to hash-based embeddings
-            return self._generate_hash_embeddings(texts)
+            return self._generate_hash_embeddings(texts), True
+    
+    @staticmethod
+    def _batch(items: List[str], size: int) -> List[List[str]]:
+        """Split items into consecutive groups of at most size"""
+        return [items[i:i + size] for i in range(0, len(items), size)]
     
-    def _generate_hash_embeddings(self, texts: List[str]) -> List[List[float]]:
+    def _generate_hash_embeddings(self, texts: List[str]) -> np.ndarray:
         """Generate deterministic hash-based embeddings as fallback"""
-        import hashlib
-        embeddings = []
-        for text in texts:
-            # Create deterministic hash-based embedding
-            text_hash = hashlib.md5(text.encode()).hexdigest()
-            embedding = []
-            for i in range(0, min(len(text_hash), 384), 2):
-                embedding.append(float(int(text_hash[i:i+2], 16)) / 255.0)
-            # Pad to 384 dimensions
-            while len(embedding) < 384:
-                embedding.append(0.0)
-            embeddings.append(embedding[:384])
+        embeddings = np.zeros((len(texts), 384), dtype=np.float32)
+        if not texts:
+            return embeddings
+        # One 16-byte MD5 digest per text in the first 16 dimensions, zero-padded to 384
+        digests = np.frombuffer(b"".join(hashlib.md5(text.encode()).digest() for text in texts), dtype=np.uint8)
+        embeddings[:, :16] = digests.reshape(len(texts), 16) / 255.0
         return embeddings
     
-    def add_document(self, user_id: str, content: str, source: str, content_type: str) -> str:
-        """Add a document to user's collection with comprehensive error handling"""
+    def flush(self) -> Dict[str, Exception]:
+        """Write any chunks still buffered
+        
+        Returns content_id -> error for every buffered document that could
+        not be written since the last call, including documents dropped by a
+        flush that another add_document call triggered.
+        """
+        self._flush_buffer()
+        failures, self._write_failures = self._write_failures, {}
+        return failures
+    
+    def _flush_buffer(self):
+        """Write buffered chunks, keeping failures for the next flush() to report"""
+        self._write_failures.update(self._ingester.flush())
+    
+    def _record_written(self, ids: List[str], embeddings: np.ndarray, metadatas: List[Dict]):
+        """Index documents whose last chunk has just been stored"""
+        self._update_candidate_indexes(ids, metadatas, embeddings)
+        for metadata in metadatas:
+            total_chunks = metadata.get("total_chunks")
+            if total_chunks is None or metadata.get("chunk_index") != total_chunks - 1:
+                continue
+            key = (metadata["user_id"], metadata["content_id"])
+            self._doc_chunk_counts[key] = total_chunks
+            content_hash = metadata.get("content_hash")
+            if content_hash is not None:
+                self._pending_hashes.pop((key[0], content_hash), None)
+                self._content_hashes[(key[0], content_hash)] = key[1]
+                self._doc_hashes[key] = content_hash
+    
+    def _forget_dropped(self, ids: List[str], metadatas: List[Dict]):
+        """Stop treating documents whose write failed as stored or pending"""
+        self._update_candidate_indexes(ids, metadatas)
+        for metadata in metadatas:
+            content_hash = metadata.get("content_hash")
+            if content_hash is not None:
+                self._pending_hashes.pop((metadata["user_id"], content_hash), None)
+    
+    def _update_candidate_indexes(self, ids: List[str], metadatas: List[Dict], embeddings: Optional[np.ndarray] = None):
+        """Add stored chunks to (or, without embeddings, remove chunks from) built candidate indexes"""
+        rows_by_user = defaultdict(list)
+        for row, metadata in enumerate(metadatas):
+            if metadata["user_id"] in self._quantized_indexes:
+                rows_by_user[metadata["user_id"]].append(row)
+        for user_id, rows in rows_by_user.items():
+            index = self._quantized_indexes[user_id]
+            try:
+                if embeddings is None:
+                    index.remove([ids[row] for row in rows])
+                else:
+                    index.add([ids[row] for row in rows], embeddings[rows])
+            except Exception as e:
+                # Rebuilt from the collection on the next search
+                logging.warning(f"Discarding candidate index for user {user_id}: {str(e)}")
+                self._quantized_indexes.pop(user_id, None)
+    
+    def add_document(self, user_id: str, content: str, source: str, content_type: str, flush: bool = True) -> str:
+        """Add a document to the user's chunks with comprehensive error handling
+        
+        With flush=False the chunks stay buffered so several documents can be
+        written together; call flush() once the batch is complete.
+        """
         try:
-            logging.info(f"Starting document addition for user {user_id}, source: {source}")
+            logger.debug("Starting document addition for user %s, source: %s", user_id, source)
             
             # Validate inputs
             if not content or len(content.strip()) < 10:
@@ -172,29 +593,26 @@ class RAGPipeline:
             if not user_id:
                 raise ValueError("User ID is required")
             
-            # Get or create user collection
-            try:
-                collection = self.get_user_collection(user_id)
-                logging.info(f"Retrieved existing collection for user {user_id}")
-            except Exception as e:
-                logging.info(f"Collection not found for user {user_id}, creating new one: {str(e)}")
-                collection_name = self.create_user_collection(user_id)
-                collection = self.get_user_collection(user_id)
-                logging.info(f"Created new collection: {collection_name}")
+            # Re-uploads of identical content reuse the stored document
+            content_hash = hashlib.sha256(content.encode()).hexdigest()
+            existing_id = self._find_document_by_hash(user_id, content_hash)
+            if existing_id is not None:
+                logging.info(f"Document {source} already stored as {existing_id}, skipping")
+                return existing_id
             
             # Chunk the content
-            logging.info(f"Chunking content of length {len(content)}")
+            logger.debug("Chunking content of length %d", len(content))
             chunks = self.chunk_text(content)
-            logging.info(f"Created {len(chunks)} chunks")
+            logger.debug("Created %d chunks", len(chunks))
             
             if not chunks:
                 raise ValueError("No chunks created from content")
             
             # Generate embeddings
-            logging.info("Generating embeddings for chunks")
+            logger.debug("Generating embeddings for chunks")
             try:
                 embeddings = self.generate_embeddings(chunks)
-                logging.info(f"Generated {len(embeddings)} embeddings")
+                logger.debug("Generated %d embeddings", len(embeddings))
             except Exception as e:
                 logging.error(f"Failed to generate embeddings: {str(e)}")
                 raise ValueError(f"Failed to generate embeddings: {str(e)}")
@@ -202,15 +620,17 @@ class RAGPipeline:
             # Generate unique IDs
             content_id = str(uuid.uuid4())
             chunk_ids = [f"{content_id}_chunk_{i}" for i in range(len(chunks))]
-            logging.info(f"Generated content ID: {content_id}")
+            logger.debug("Generated content ID: %s", content_id)
             
             # Prepare metadata
             metadatas = []
             for i, chunk in enumerate(chunks):
                 metadata = {
+                    "user_id": user_id,
                     "content_id": content_id,
                     "source": source,
                     "content_type": content_type,
+                    "content_hash": content_hash,
                     "chunk_index": i,
                     "total_chunks": len(chunks),
                     "chunk_length": len(chunk)
@@ -218,15 +638,19 @@ class RAGPipeline:
                 metadatas.append(metadata)
             
             # Add to collection
-            logging.info("Adding chunks to vector store")
+            logger.debug("Adding chunks to vector store")
             try:
-                collection.add(
-                    ids=chunk_ids,
-                    embeddings=embeddings,
-                    documents=chunks,
-                    metadatas=metadatas
-                )
-                logging.info(f"Successfully added {len(chunks)} chunks to vector store")
+                # Hash and count maps are filled in by _record_written once the write succeeds
+                self._pending_hashes[(user_id, content_hash)] = content_id
+                failures = self._ingester.add(chunk_ids, embeddings, chunks, metadatas)
+                if flush:
+                    failures.update(self._ingester.flush())
+                # Only this document's failure is raised here; others wait for flush()
+                error = failures.pop(content_id, None)
+                self._write_failures.update(failures)
+                if error is not None:
+                    raise error
+                logger.debug("Successfully added %d chunks to vector store", len(chunks))
             except Exception as e:
                 logging.error(f"Failed to add chunks to collection: {str(e)}")
                 raise ValueError(f"Failed to add chunks to vector store: {str(e)}")
@@ -238,30 +662,54 @@ class RAGPipeline:
             logging.error(f"Error adding document for user {user_id}: {str(e)}")
             raise
     
+    def _find_document_by_hash(self, user_id: str, content_hash: str) -> Optional[str]:
+        """Return the content_id of the user's document with this content hash, if any"""
+        content_id = self._content_hashes.get((user_id, content_hash)) or self._pending_hashes.get((user_id, content_hash))
+        if content_id is not None:
+            return content_id
+        existing = self.collection.get(
+            where=self._user_filter(user_id, content_hash=content_hash),
+            limit=1,
+            include=["metadatas"]
+        )
+        if existing['ids']:
+            return existing['metadatas'][0]["content_id"]
+        return None
+    
     def search_relevant_chunks(self, user_id: str, query: str, top_k: int = 5) -> List[Dict]:
-        """Search for relevant chunks in user's collection"""
+        """Search for relevant chunks among the user's documents"""
         try:
-            collection = self.get_user_collection(user_id)
+            self._flush_buffer()
+            
+            # Generate query embedding (cached per query string, float32)
+            query_vector = self._embed_query(query)
             
-            # Generate query embedding
-            query_embeddings = self.generate_embeddings([query])
+            index = self._get_quantized_index(user_id)
+            if index is None:
+                return []
             
-            # Search collection
-            results = collection.query(
-                query_embeddings=query_embeddings,
-                n_results=top_k
+            # Binary then int8 candidates, reranked on their fp32 embeddings
+            candidate_ids = index.search(
+                query_vector,
+                top_k * self.rescore_oversample,
+                coarse_k=top_k * self.binary_oversample
+            )
+            candidates = self.collection.get(ids=candidate_ids, include=["embeddings", "documents", "metadatas"])
+            
+            vectors = np.asarray(candidates['embeddings'], dtype=np.float32)
+            similarities = vectors @ query_vector / np.maximum(
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector), 1e-12
             )
             
             # Format results
             relevant_chunks = []
-            if results['documents'] and results['documents'][0]:
-                for i, doc in enumerate(results['documents'][0]):
-                    chunk_data = {
-                        "content": doc,
-                        "metadata": results['metadatas'][0][i],
-                        "distance": results['distances'][0][i] if results['distances'] else 0
-                    }
-                    relevant_chunks.append(chunk_data)
+            for i in np.argsort(-similarities)[:top_k]:
+                chunk_data = {
+                    "content": candidates['documents'][i],
+                    "metadata": candidates['metadatas'][i],
+                    "distance": float(1 - similarities[i])  # cosine distance, as in the collection's space
+                }
+                relevant_chunks.append(chunk_data)
             
             return relevant_chunks
             
@@ -269,17 +717,50 @@ class RAGPipeline:
             logging.error(f"Error searching chunks for user {user_id}: {str(e)}")
             return []
     
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Embed a query, reusing the cached vector for repeated questions
+        
+        Vectors from the error-path hash fallback are not cached, so a
+        transient Gemini failure doesn't pin a meaningless vector to the query.
+        """
+        embedding = self._query_cache.get(query)
+        if embedding is not None:
+            self._query_cache.move_to_end(query)
+            return embedding
+        embeddings, degraded = self._generate_embeddings([query])
+        embedding = embeddings[0]
+        embedding.flags.writeable = False  # shared by every cache hit
+        if not degraded:
+            self._query_cache[query] = embedding
+            if len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return embedding
+    
+    def _get_quantized_index(self, user_id: str):
+        """Return the user's candidate index, building it from their chunks if needed"""
+        index = self._quantized_indexes.get(user_id)
+        if index is None:
+            stored = self.collection.get(where=self._user_filter(user_id), include=["embeddings"])
+            if not stored['ids']:
+                return None
+            index_class = HNSWIndex if self.candidate_index == "hnsw" else QuantizedIndex
+            index = index_class(stored['ids'], stored['embeddings'])
+            self._quantized_indexes[user_id] = index
+        return index if len(index) else None
+    
     def generate_rag_response(self, query: str, user_id: str) -> Tuple[str, List[Dict]]:
         """Generate RAG response using user's documents"""
+        if self.gemini_model is None:
+            return self.generate_general_response(query), []
         try:
             # First check if user has any documents
             try:
-                collection = self.get_user_collection(user_id)
-                if collection.count() == 0:
+                self._flush_buffer()
+                if not self.collection.get(where=self._user_filter(user_id), limit=1, include=[])['ids']:
                     logging.info(f"No documents found for user {user_id}, falling back to general response")
                     return self.generate_general_response(query), []
             except Exception as e:
-                logging.warning(f"Could not access user collection for {user_id}: {str(e)}")
+                logging.warning(f"Could not access documents for {user_id}: {str(e)}")
                 return self.generate_general_response(query), []
             
             # Search for relevant chunks
@@ -293,19 +774,25 @@ class RAGPipeline:
             # Prepare context from relevant chunks (limit to avoid token limits)
             context_parts = []
             sources = []
-            max_context_length = 2000  # Limit context to avoid token limits
+            if _TOKEN_ENCODING is not None:
+                measure = lambda text: len(_TOKEN_ENCODING.encode(text))
+                max_context_length = 500  # tokens, about the old 2000-character budget
+            else:
+                measure = len
+                max_context_length = 2000  # characters
             
             current_length = 0
             for chunk in relevant_chunks:
-                if current_length + len(chunk['content']) > max_context_length:
+                chunk_length = measure(chunk['content'])
+                if current_length + chunk_length > max_context_length:
                     break
+                current_length += chunk_length
                 context_parts.append(chunk['content'])
                 sources.append({
                     "source": chunk['metadata']['source'],
                     "content_type": chunk['metadata']['content_type'],
                     "relevance_score": 1 - chunk['distance']  # Convert distance to relevance
                 })
-                current_length += len(chunk['content'])
             
             if not context_parts:
                 return self.generate_general_response(query), []
@@ -336,6 +823,8 @@ Please provide a helpful response based on the context above. If you reference s
     
     def generate_general_response(self, query: str) -> str:
         """Generate general response using Gemini with comprehensive error handling"""
+        if self.gemini_model is None:
+            return "I'm sorry, but the AI service is not configured. Please set the GEMINI_API_KEY."
         try:
             response = self.gemini_model.generate_content(query)
             return response.text
@@ -353,28 +842,40 @@ Please provide a helpful response based on the context above. If you reference s
                 return f"I encountered an error: {str(e)[:100]}... Please try again."
     
     def delete_document(self, user_id: str, content_id: str):
-        """Delete a document from user's collection"""
+        """Delete a document from the user's chunks"""
         try:
-            collection = self.get_user_collection(user_id)
-            
-            # Get all chunks for this content_id
-            results = collection.get(where={"content_id": content_id})
-            
-            if results['ids']:
-                collection.delete(ids=results['ids'])
+            self._flush_buffer()
+            
+            # Chunk ids are "{content_id}_chunk_{i}", so knowing the chunk count is enough
+            total_chunks = self._doc_chunk_counts.pop((user_id, content_id), None)
+            if total_chunks is None:
+                # Not added by this process: read the count from the first chunk's metadata
+                first = self.collection.get(ids=[f"{content_id}_chunk_0"], include=["metadatas"])
+                if not first['ids'] or first['metadatas'][0].get("user_id") != user_id:
+                    return
+                total_chunks = first['metadatas'][0]["total_chunks"]
+            
+            chunk_ids = [f"{content_id}_chunk_{i}" for i in range(total_chunks)]
+            self.collection.delete(ids=chunk_ids)
+            index = self._quantized_indexes.get(user_id)
+            if index is not None:
+                index.remove(chunk_ids)
+            content_hash = self._doc_hashes.pop((user_id, content_id), None)
+            if content_hash is not None:
+                self._content_hashes.pop((user_id, content_hash), None)
                 
         except Exception as e:
             logging.error(f"Error deleting document {content_id} for user {user_id}: {str(e)}")
             raise
     
     def get_collection_stats(self, user_id: str) -> Dict:
-        """Get statistics about user's collection"""
+        """Get statistics about the user's documents"""
         try:
-            collection = self.get_user_collection(user_id)
-            count = collection.count()
+            self._flush_buffer()
             
             # Get unique content IDs
-            results = collection.get()
+            results = self.collection.get(where=self._user_filter(user_id), include=["metadatas"])
+            count = len(results['ids'])
             content_ids = set()
             if results['metadatas']:
                 for metadata in results['metadatas']:
@@ -2,32 +2,46 @@ from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import uvicorn
+import asyncio
+import codecs
+import functools
+import io
 import os
+import tempfile
+import threading
+import uuid
 import logging
 import time
-from typing import List, Optional
+from collections import defaultdict
+from typing import Dict, List, Optional
 import jwt
 from datetime import datetime, timedelta
-import hashlib
-import secrets
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
+from cachetools import TTLCache
 from dotenv import load_dotenv
 import google.generativeai as genai
 
-# Configure logging
+# Configure logging; debug output is formatted only when the level is lowered
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-else:
-    gemini_model = None
+if not GEMINI_API_KEY:
     logging.warning("GEMINI_API_KEY not found. Using fallback responses.")
 
+@functools.lru_cache(maxsize=None)
+def get_gemini_model():
+    """Create the Gemini model on first use; None when no API key is configured"""
+    if not GEMINI_API_KEY:
+        return None
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel('gemini-1.5-flash')
+
 app = FastAPI(title="RAG Chatbot API", version="1.0.0")
 
 # CORS middleware
@@ -43,40 +57,65 @@ app.add_middleware(
 users_db = {}
 tokens_db = {}
 uploaded_content = {}
+# user_id -> content_ids in upload order, so listing doesn't scan every upload
+user_content_index: Dict[str, List[str]] = defaultdict(list)
+
+# Uploads are extracted and stored by a background worker; content_id -> status
+INGEST_QUEUE: asyncio.Queue = asyncio.Queue()
+INGEST_BATCH_SIZE = 64
+INGEST_BATCH_TIMEOUT = 0.1
+ingest_status = {}
+
+# Uploads are copied in 1MB reads to a temp file that stays in memory up to 8MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_MAX_SIZE = 8 * 1024 * 1024
 
 # Simple auth functions
+# Argon2id with the same parameters as main.py and auth.py; salt is embedded in the hash
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 def hash_password(password: str) -> str:
-    salt = secrets.token_hex(16)
-    password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}:{password_hash}"
+    return _ph.hash(password)
 
 def verify_password(password: str, hashed_password: str) -> bool:
     try:
-        salt, password_hash = hashed_password.split(":")
-        return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
-    except:
+        return _ph.verify(hashed_password, password)
+    except (VerificationError, InvalidHash):
         return False
 
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
+
+# Verified token payloads: token -> payload. Entries expire after at most 60s and
+# never outlive the token's own exp claim; failed verifications are never cached.
+TOKEN_CACHE_TTL = 60
+_token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
 def create_token(user_id: str) -> str:
     payload = {
         "user_id": user_id,
         "exp": datetime.utcnow() + timedelta(days=7)  # Extended to 7 days
     }
-    secret_key = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
-    token = jwt.encode(payload, secret_key, algorithm="HS256")
-    print(f"DEBUG: Created token for user {user_id}, expires in 7 days")
+    token = jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")
+    logger.debug("Created token for user %s, expires in 7 days", user_id)
     return token
 
 def verify_token(token: str) -> Optional[dict]:
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
     try:
-        print(f"DEBUG: Verifying token: {token[:20]}...")
-        secret_key = os.getenv("JWT_SECRET_KEY", "demo-secret-key")
-        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
-        print(f"DEBUG: Token verified successfully for user: {payload.get('user_id')}")
-        return payload
-    except Exception as e:
-        print(f"DEBUG: Token verification failed: {e}")
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"], options={"require": ["exp"]})
+    except Exception:
         return None
+    
+    expires_at = min(payload["exp"], now + TOKEN_CACHE_TTL)
+    with _token_cache_lock:
+        _token_cache[token] = (expires_at, payload)
+    return payload
 
 # Auth endpoints
 @app.post("/api/auth/register")
@@ -131,15 +170,11 @@ async def login(email: str = Form(...), password: str = Form(...)):
 
 # Simple auth dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-    token = credentials.credentials
-    print(f"DEBUG: get_current_user called with token: {token[:20]}...")
-    payload = verify_token(token)
+    payload = verify_token(credentials.credentials)
     
     if not payload:
-        print(f"DEBUG: Token verification failed, raising 401")
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    print(f"DEBUG: User authenticated successfully: {payload.get('user_id')}")
     return payload
 
 @app.post("/api/auth/refresh")
@@ -163,6 +198,7 @@ async def health_check():
 @app.post("/api/chat/general")
 async def chat_general(message: str = Form(...)):
     try:
+        gemini_model = get_gemini_model()
         if gemini_model:
             # Use real Gemini API
             response = gemini_model.generate_content(message)
@@ -193,6 +229,7 @@ async def chat_general(message: str = Form(...)):
 @app.post("/api/chat/rag")
 async def chat_rag(message: str = Form(...), user: dict = Depends(get_current_user)):
     try:
+        gemini_model = get_gemini_model()
         if gemini_model:
             # Use real Gemini API for RAG
             response = gemini_model.generate_content(f"Based on the user's uploaded documents, please answer: {message}")
@@ -223,88 +260,158 @@ async def chat_rag(message: str = Form(...), user: dict = Depends(get_current_us
                 "sources": []
             }
 
+# Content ingestion
+def extract_text(filename: str, stream) -> str:
+    """Extract text from an uploaded file stream based on its extension"""
+    file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
+    
+    if file_extension in ['txt', 'md']:
+        # Decode chunk by chunk; multi-byte characters split across reads are carried over
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        text = io.StringIO()
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            text.write(decoder.decode(chunk))
+        text.write(decoder.decode(b'', final=True))
+        return text.getvalue()
+    elif file_extension == 'pdf':
+        # Simple PDF text extraction (you'd need PyPDF2 for real PDF processing)
+        return f"PDF content from {filename} (text extraction not implemented in simple version)"
+    else:
+        return f"Content from {filename} (file type: {file_extension})"
+
+def ingest_batch(batch: list):
+    """Extract and store a batch of queued uploads"""
+    for item in batch:
+        content_id = item["content_id"]
+        try:
+            text_content = extract_text(item["filename"], item["file"])
+            # Store the record before indexing it, so list_content never sees an id without one
+            uploaded_content[content_id] = {
+                "filename": item["filename"],
+                "content": text_content,
+                "size": item["size"],
+                "user_id": item["user_id"],
+                "upload_time": item["upload_time"]
+            }
+            user_content_index[item["user_id"]].append(content_id)
+            ingest_status[content_id].update(status="processed", text_length=len(text_content))
+        except Exception as e:
+            logging.error(f"Error ingesting {content_id}: {str(e)}")
+            ingest_status[content_id].update(status="failed", error=str(e))
+        finally:
+            item["file"].close()
+
+async def _ingest_worker():
+    """Drain INGEST_QUEUE in batches of up to INGEST_BATCH_SIZE items or INGEST_BATCH_TIMEOUT seconds"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await INGEST_QUEUE.get()]
+        deadline = loop.time() + INGEST_BATCH_TIMEOUT
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(INGEST_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await asyncio.to_thread(ingest_batch, batch)
+        finally:
+            for _ in batch:
+                INGEST_QUEUE.task_done()
+
+@app.on_event("startup")
+async def start_ingest_worker():
+    app.state.ingest_worker = asyncio.create_task(_ingest_worker())
+
+@app.on_event("shutdown")
+async def stop_ingest_worker():
+    app.state.ingest_worker.cancel()
+
 # Content management endpoints
-@app.post("/api/content/upload")
+@app.post("/api/content/upload", status_code=202)
 async def upload_file(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
     try:
-        print(f"DEBUG: Uploading file: {file.filename} for user: {user.get('user_id')}")
+        logger.debug("Uploading file: %s for user: %s", file.filename, user.get('user_id'))
         
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
         
-        # Read file content
-        content = await file.read()
-        print(f"DEBUG: File size: {len(content)} bytes")
+        # Copy the upload in fixed-size reads so peak memory doesn't grow with file size
+        spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+        size = 0
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            spool.write(chunk)
+            size += len(chunk)
+        logger.debug("File size: %d bytes", size)
         
-        if len(content) == 0:
+        if size == 0:
+            spool.close()
             raise HTTPException(status_code=400, detail="Empty file provided")
+        spool.seek(0)
         
-        # Extract text from file based on extension
-        file_extension = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
-        text_content = ""
-        
-        if file_extension in ['txt', 'md']:
-            try:
-                text_content = content.decode('utf-8')
-            except UnicodeDecodeError:
-                text_content = content.decode('utf-8', errors='ignore')
-        elif file_extension == 'pdf':
-            # Simple PDF text extraction (you'd need PyPDF2 for real PDF processing)
-            text_content = f"PDF content from {file.filename} (text extraction not implemented in simple version)"
-        else:
-            text_content = f"Content from {file.filename} (file type: {file_extension})"
-        
-        print(f"DEBUG: Extracted text length: {len(text_content)}")
-        
-        # Store in simple in-memory storage
-        content_id = f"content_{int(time.time())}"
-        uploaded_content[content_id] = {
+        # Text extraction and storage happen on the ingest worker
+        content_id = uuid.uuid4().hex
+        ingest_status[content_id] = {"status": "queued", "user_id": user["user_id"]}
+        await INGEST_QUEUE.put({
+            "content_id": content_id,
             "filename": file.filename,
-            "content": text_content,
-            "size": len(content),
+            "file": spool,
+            "size": size,
             "user_id": user["user_id"],
             "upload_time": time.time()
-        }
+        })
         
-        print(f"DEBUG: File uploaded successfully with ID: {content_id}")
+        logger.debug("File queued for processing with ID: %s", content_id)
         
         return {
-            "message": "File uploaded and processed successfully",
+            "message": "File uploaded, processing in background",
+            "status": "queued",
             "filename": file.filename,
-            "size": len(content),
+            "size": size,
             "content_id": content_id,
-            "text_length": len(text_content)
+            # Known once the worker has extracted the text; see /api/content/status/{content_id}
+            "text_length": None
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"DEBUG: Upload error: {str(e)}")
+        logger.error("Upload error: %s", e)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+@app.get("/api/content/status/{content_id}")
+async def content_status(content_id: str, user: dict = Depends(get_current_user)):
+    status = ingest_status.get(content_id)
+    if status is None or status["user_id"] != user["user_id"]:
+        raise HTTPException(status_code=404, detail="Content not found")
+    return {"content_id": content_id, **{k: v for k, v in status.items() if k != "user_id"}}
+
 @app.get("/api/content/list")
 async def list_content(user: dict = Depends(get_current_user)):
     try:
-        print(f"DEBUG: Listing content for user: {user.get('user_id')}")
+        logger.debug("Listing content for user: %s", user.get('user_id'))
         
         # Get content for this user
         user_content = []
-        for content_id, content_data in uploaded_content.items():
-            if content_data.get('user_id') == user.get('user_id'):
-                user_content.append({
-                    "id": content_id,
-                    "filename": content_data.get('filename'),
-                    "size": content_data.get('size'),
-                    "upload_time": content_data.get('upload_time')
-                })
+        for content_id in user_content_index.get(user.get('user_id'), []):
+            content_data = uploaded_content[content_id]
+            user_content.append({
+                "id": content_id,
+                "filename": content_data.get('filename'),
+                "size": content_data.get('size'),
+                "upload_time": content_data.get('upload_time')
+            })
         
-        print(f"DEBUG: Found {len(user_content)} files for user")
+        logger.debug("Found %d files for user", len(user_content))
         
         return {
             "content": user_content
         }
     except Exception as e:
-        print(f"DEBUG: Error listing content: {str(e)}")
+        logger.error("Error listing content: %s", e)
         return {
             "content": []
         }
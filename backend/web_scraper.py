@@ -1,19 +1,81 @@
+import asyncio
+import httpx
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.lexbor import LexborHTMLParser
 import re
 from typing import Dict, Optional
 import logging
 from urllib.parse import urlparse, urljoin
 import time
 
+_WS_RE = re.compile(r'\s+')
+# http(s) scheme followed by a non-empty host; the only URLs the scraper can fetch
+_URL_RE = re.compile(r'^https?://[^/\s]+', re.IGNORECASE)
+# Common unwanted phrases, fused into one alternation so they are removed in a single pass
+_UNWANTED_RE = re.compile(
+    r'Advertisement|Subscribe|Newsletter|Follow us|Share this|Cookie policy|Privacy policy|Terms of service',
+    re.IGNORECASE
+)
+
+# Metadata sources per field, in priority order, and the one selector that matches them all
+_METADATA_SOURCES = (
+    ('description', ('name:description',)),
+    ('keywords', ('name:keywords',)),
+    ('author', ('name:author', '.author', '.byline', 'rel:author')),
+    ('published_date', ('property:article:published_time', 'name:date', '.date', '.published', '.publish-date')),
+)
+_META_NAMES = frozenset(('description', 'keywords', 'author', 'date'))
+_METADATA_CLASSES = frozenset(('author', 'byline', 'date', 'published', 'publish-date'))
+_METADATA_SELECTOR = 'meta, .author, .byline, [rel="author"], .date, .published, .publish-date'
+
+class _TokenBucket:
+    """Request budget that refills at rate tokens/s up to capacity, allowing short bursts"""
+    __slots__ = ('tokens', 'rate', 'capacity', 'last')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.tokens = capacity
+        self.rate = rate
+        self.capacity = capacity
+        self.last = time.monotonic()
+    
+    def take(self) -> float:
+        """Reserve one token and return how many seconds to wait before using it
+        
+        The balance may go negative, so concurrent callers queue up behind
+        each other instead of all waking at the same moment.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
 class WebScraper:
     def __init__(self):
         self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
         }
         self.session = requests.Session()
         self.session.headers.update(self.headers)
+        
+        # Pooled keep-alive connections (sized for concurrent batch scraping) with light retries
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.3)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.timeout = 30
+        self.max_concurrency = 20  # total in-flight requests in scrape_multiple_urls
+        self.max_per_host = 2  # in-flight requests per host, to stay polite
+        self.host_rate = 2.0  # sustained requests per second per host
+        self.host_burst = 5
+        self._host_buckets = {}  # netloc -> _TokenBucket
     
     def scrape_url(self, url: str) -> Optional[Dict]:
         """Scrape content from a URL"""
@@ -26,37 +88,64 @@ class WebScraper:
             response = self.session.get(url, timeout=self.timeout)
             response.raise_for_status()
             
-            # Parse HTML
-            soup = BeautifulSoup(response.content, 'html.parser')
+            return self._parse_page(response.content, url)
             
-            # Extract content
-            content = self._extract_content(soup, url)
+        except requests.RequestException as e:
+            logging.error(f"Request error for URL {url}: {str(e)}")
+            raise Exception(f"Failed to fetch URL: {str(e)}")
+        except Exception as e:
+            logging.error(f"Error scraping URL {url}: {str(e)}")
+            raise Exception(f"Failed to scrape URL: {str(e)}")
+    
+    async def _scrape_url_async(self, client: httpx.AsyncClient, url: str, host_slots: Dict[str, asyncio.Semaphore]) -> Dict:
+        """Async counterpart of scrape_url; parsing runs in the default executor"""
+        try:
+            if not self._is_valid_url(url):
+                raise ValueError("Invalid URL format")
             
-            if not content or len(content.get('text', '').strip()) < 100:
-                raise ValueError("Insufficient content extracted from URL")
+            host = urlparse(url).netloc
+            bucket = self._host_buckets.get(host)
+            if bucket is None:
+                bucket = self._host_buckets[host] = _TokenBucket(self.host_rate, self.host_burst)
+            await asyncio.sleep(bucket.take())
             
-            return content
+            slots = host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+            async with slots:
+                response = await client.get(url)
+            response.raise_for_status()
             
-        except requests.RequestException as e:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._parse_page, response.content, url)
+            
+        except httpx.HTTPError as e:
             logging.error(f"Request error for URL {url}: {str(e)}")
             raise Exception(f"Failed to fetch URL: {str(e)}")
         except Exception as e:
             logging.error(f"Error scraping URL {url}: {str(e)}")
             raise Exception(f"Failed to scrape URL: {str(e)}")
     
+    def _parse_page(self, html: bytes, url: str) -> Dict:
+        """Parse fetched HTML and extract its content"""
+        # Parse HTML (Lexbor: parsing and CSS selection run in C)
+        tree = LexborHTMLParser(html)
+        
+        # Extract content
+        content = self._extract_content(tree, url)
+        
+        if not content or len(content.get('text', '').strip()) < 100:
+            raise ValueError("Insufficient content extracted from URL")
+        
+        return content
+    
     def _is_valid_url(self, url: str) -> bool:
         """Validate URL format"""
-        try:
-            result = urlparse(url)
-            return all([result.scheme, result.netloc])
-        except:
-            return False
+        return isinstance(url, str) and _URL_RE.match(url) is not None
     
-    def _extract_content(self, soup: BeautifulSoup, url: str) -> Dict:
+    def _extract_content(self, tree: LexborHTMLParser, url: str) -> Dict:
         """Extract meaningful content from HTML"""
         # Remove script and style elements
-        for script in soup(["script", "style", "nav", "footer", "header", "aside"]):
-            script.decompose()
+        for node in tree.css('script, style, nav, footer, header, aside'):
+            node.decompose()
         
         # Try to find main content using common selectors
         content_selectors = [
@@ -75,22 +164,22 @@ class WebScraper:
         
         main_content = None
         for selector in content_selectors:
-            main_content = soup.select_one(selector)
-            if main_content and len(main_content.get_text().strip()) > 200:
+            main_content = tree.css_first(selector)
+            if main_content and len(main_content.text().strip()) > 200:
                 break
         
         # If no main content found, use body
         if not main_content:
-            main_content = soup.find('body') or soup
+            main_content = tree.body or tree.root
         
         # Extract title
-        title = self._extract_title(soup)
+        title = self._extract_title(tree)
         
         # Extract text content
-        text_content = self._clean_text(main_content.get_text())
+        text_content = self._clean_node_text(main_content)
         
         # Extract metadata
-        metadata = self._extract_metadata(soup)
+        metadata = self._extract_metadata(tree)
         
         return {
             'title': title,
@@ -100,7 +189,7 @@ class WebScraper:
             'scraped_at': time.time()
         }
     
-    def _extract_title(self, soup: BeautifulSoup) -> str:
+    def _extract_title(self, tree: LexborHTMLParser) -> str:
         """Extract page title"""
         title = None
         
@@ -108,9 +197,9 @@ class WebScraper:
         title_selectors = ['title', 'h1', '.title', '.post-title', '.entry-title']
         
         for selector in title_selectors:
-            element = soup.select_one(selector)
+            element = tree.css_first(selector)
             if element:
-                title = element.get_text().strip()
+                title = element.text().strip()
                 if title and len(title) > 3:
                     break
         
@@ -118,95 +207,119 @@ class WebScraper:
     
     def _clean_text(self, text: str) -> str:
         """Clean and normalize text content"""
-        # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Remove common unwanted patterns
-        unwanted_patterns = [
-            r'Advertisement',
-            r'Subscribe',
-            r'Newsletter',
-            r'Follow us',
-            r'Share this',
-            r'Cookie policy',
-            r'Privacy policy',
-            r'Terms of service'
-        ]
-        
-        for pattern in unwanted_patterns:
-            text = re.sub(pattern, '', text, flags=re.IGNORECASE)
-        
-        return text.strip()
+        # Collapse whitespace, then drop common unwanted patterns
+        return _UNWANTED_RE.sub('', _WS_RE.sub(' ', text)).strip()
     
-    def _extract_metadata(self, soup: BeautifulSoup) -> Dict:
-        """Extract metadata from HTML"""
-        metadata = {}
+    def _clean_node_text(self, node) -> str:
+        """Clean a node's text one text node at a time
         
-        # Extract meta description
-        meta_desc = soup.find('meta', attrs={'name': 'description'})
-        if meta_desc:
-            metadata['description'] = meta_desc.get('content', '')
-        
-        # Extract meta keywords
-        meta_keywords = soup.find('meta', attrs={'name': 'keywords'})
-        if meta_keywords:
-            metadata['keywords'] = meta_keywords.get('content', '')
-        
-        # Extract author
-        author_selectors = [
-            'meta[name="author"]',
-            '.author',
-            '.byline',
-            '[rel="author"]'
-        ]
+        Equivalent to _clean_text(node.text()), but whitespace is collapsed per
+        text node, so the full raw page text is never materialized or rescanned.
+        """
+        parts = []
+        trailing_space = True  # leading whitespace of the first node is dropped anyway
+        for child in node.traverse(include_text=True):
+            if child.tag != '-text':
+                continue
+            text = _WS_RE.sub(' ', child.text_content)
+            if trailing_space and text.startswith(' '):
+                text = text[1:]
+            if text:
+                parts.append(text)
+                trailing_space = text.endswith(' ')
+        return _UNWANTED_RE.sub('', ''.join(parts)).strip()
+    
+    def _extract_metadata(self, tree: LexborHTMLParser) -> Dict:
+        """Extract metadata from HTML
         
-        for selector in author_selectors:
-            author_elem = soup.select_one(selector)
-            if author_elem:
-                metadata['author'] = author_elem.get('content') or author_elem.get_text()
-                break
+        All candidate nodes are collected in one tree walk; the first match for
+        each source is kept and sources are then ranked in priority order.
+        """
+        found = {}  # source -> first matching node
+        for node in tree.css(_METADATA_SELECTOR):
+            attrs = node.attributes
+            if node.tag == 'meta':
+                name = attrs.get('name')
+                if name in _META_NAMES:
+                    found.setdefault('name:' + name, node)
+                if attrs.get('property') == 'article:published_time':
+                    found.setdefault('property:article:published_time', node)
+            for cls in (attrs.get('class') or '').split():
+                if cls in _METADATA_CLASSES:
+                    found.setdefault('.' + cls, node)
+            if attrs.get('rel') == 'author':
+                found.setdefault('rel:author', node)
         
-        # Extract publication date
-        date_selectors = [
-            'meta[property="article:published_time"]',
-            'meta[name="date"]',
-            '.date',
-            '.published',
-            '.publish-date'
-        ]
-        
-        for selector in date_selectors:
-            date_elem = soup.select_one(selector)
-            if date_elem:
-                metadata['published_date'] = date_elem.get('content') or date_elem.get_text()
-                break
+        metadata = {}
+        for key, sources in _METADATA_SOURCES:
+            for source in sources:
+                node = found.get(source)
+                if node is not None:
+                    if key in ('description', 'keywords'):
+                        metadata[key] = node.attributes.get('content') or ''
+                    else:
+                        metadata[key] = node.attributes.get('content') or node.text()
+                    break
         
         return metadata
     
     def scrape_multiple_urls(self, urls: list) -> Dict[str, Dict]:
-        """Scrape multiple URLs with rate limiting"""
-        results = {}
-        
-        for i, url in enumerate(urls):
-            try:
-                results[url] = self.scrape_url(url)
-                
-                # Rate limiting - wait between requests
-                if i < len(urls) - 1:
-                    time.sleep(1)
-                    
-            except Exception as e:
-                results[url] = {'error': str(e)}
-        
-        return results
+        """Scrape multiple URLs concurrently with per-host rate limiting
+        
+        Runs its own event loop, so call it from synchronous code.
+        """
+        return asyncio.run(self._scrape_all(urls))
+    
+    async def _scrape_all(self, urls: list) -> Dict[str, Dict]:
+        host_slots = {}  # netloc -> Semaphore(max_per_host)
+        async with httpx.AsyncClient(
+            headers=self.headers,
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.max_concurrency),
+            transport=httpx.AsyncHTTPTransport(retries=2)
+        ) as client:
+            # A HEAD round trip per URL skips the GET and parse for dead or non-HTML pages
+            scrapable = await asyncio.gather(*[self._is_scrapable_async(client, url, host_slots) for url in urls])
+            targets = [url for url, ok in zip(urls, scrapable) if ok]
+            pages = await asyncio.gather(
+                *[self._scrape_url_async(client, url, host_slots) for url in targets],
+                return_exceptions=True
+            )
+        
+        results = {url: {'error': 'URL is not reachable or not an HTML page'} for url, ok in zip(urls, scrapable) if not ok}
+        for url, page in zip(targets, pages):
+            results[url] = {'error': str(page)} if isinstance(page, Exception) else page
+        return {url: results[url] for url in urls}
+    
+    async def _is_scrapable_async(self, client: httpx.AsyncClient, url: str, host_slots: Dict[str, asyncio.Semaphore]) -> bool:
+        """Async counterpart of is_scrapable"""
+        if not self._is_valid_url(url):
+            return True  # let the scrape report the invalid URL
+        try:
+            slots = host_slots.setdefault(urlparse(url).netloc, asyncio.Semaphore(self.max_per_host))
+            async with slots:
+                response = await client.head(url, timeout=10)
+            return self._head_allows_scrape(response.status_code, response.headers)
+        except Exception:
+            return False
     
     def is_scrapable(self, url: str) -> bool:
         """Check if URL is likely scrapable"""
         try:
             # Quick HEAD request to check if accessible
-            response = self.session.head(url, timeout=10)
-            return response.status_code == 200
+            response = self.session.head(url, timeout=10, allow_redirects=True)
+            return self._head_allows_scrape(response.status_code, response.headers)
         except:
             return False
+    
+    @staticmethod
+    def _head_allows_scrape(status_code: int, headers) -> bool:
+        """Whether a HEAD response points at a reachable HTML page"""
+        if status_code in (405, 501):
+            # Server doesn't implement HEAD; only a GET can tell
+            return True
+        content_type = headers.get('content-type', '')
+        return status_code == 200 and content_type.startswith('text/html')
 
 
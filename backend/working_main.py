@@ -1,24 +1,40 @@
 from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.concurrency import run_in_threadpool
+from anyio.to_thread import current_default_thread_limiter
 import uvicorn
+import asyncio
 import os
 import logging
 import time
-from typing import List, Optional
+import threading
+import uuid
+import tempfile
+from itertools import repeat
+from collections import defaultdict
+from typing import Dict, List, Optional
 import jwt
 from datetime import datetime, timedelta
-import hashlib
-import secrets
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted
 import PyPDF2
 import docx
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
 import csv
 import io
+from file_processing import (
+    PDF_PARALLEL_MIN_PAGES, PDF_WORKERS, get_pdf_pool, shutdown_pdf_pool,
+    _pdf_page_ranges, _extract_pdf_page_range
+)
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
 from langchain.vectorstores import Chroma
 from langchain.chains import RetrievalQA
 
@@ -40,10 +56,15 @@ if GEMINI_API_KEY:
             temperature=0.7,
         )
     )
+    # Shared LangChain clients, reused by every upload and RAG chat
+    _EMBEDDINGS = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=GEMINI_API_KEY)
+    _CHAT_LLM = ChatGoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GEMINI_API_KEY)
     print("✅ Gemini API configured successfully")
 else:
     print("❌ GEMINI_API_KEY not found in environment variables")
     gemini_model = None
+    _EMBEDDINGS = None
+    _CHAT_LLM = None
 
 app = FastAPI(title="RAG Chatbot API", version="1.0.0")
 
@@ -60,74 +81,186 @@ app.add_middleware(
 users_db = {}
 tokens_db = {}
 uploaded_content = {}
+# user_id -> content_ids in upload order, so listing doesn't scan every upload
+user_content_index: Dict[str, List[str]] = defaultdict(list)
+
+# Per-user Chroma handles, opened once and reused by uploads and chats
+_VSTORES = {}  # user_id -> Chroma
+_vstores_lock = threading.Lock()
+
+def _get_vstore(user_id: str) -> Chroma:
+    vstore = _VSTORES.get(user_id)
+    if vstore is None:
+        with _vstores_lock:
+            vstore = _VSTORES.get(user_id)
+            if vstore is None:
+                vstore = Chroma(
+                    collection_name=f"user_{user_id}",
+                    embedding_function=_EMBEDDINGS,
+                    persist_directory=f"./chroma_db_{user_id}"
+                )
+                _VSTORES[user_id] = vstore
+    return vstore
+
+# Per-user RetrievalQA chains; their retrievers read the cached store, so new uploads are visible
+_CHAINS = {}  # user_id -> RetrievalQA
+
+def _get_chain(user_id: str) -> RetrievalQA:
+    chain = _CHAINS.get(user_id)
+    if chain is None:
+        chain = RetrievalQA.from_chain_type(
+            llm=_CHAT_LLM,
+            chain_type="stuff",
+            retriever=_get_vstore(user_id).as_retriever(search_kwargs={"k": 3}),
+            return_source_documents=False
+        )
+        _CHAINS[user_id] = chain
+    return chain
+
+# Splitter parameters are fixed, so one instance serves every upload
+_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+EMBED_BATCH_SIZE = 100  # Gemini accepts up to 100 texts per embedding request
+
+async def _embed_chunks(chunks: List[str]) -> List[List[float]]:
+    """Embed chunks as concurrent requests of up to EMBED_BATCH_SIZE texts each"""
+    batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*[asyncio.to_thread(_EMBEDDINGS.embed_documents, batch) for batch in batches])
+    return [vector for batch in results for vector in batch]
+
+def _store_chunks(user_id: str, chunks: List[str], embeddings: List[List[float]], metadata: dict) -> None:
+    """Write pre-embedded chunks to the user's store (blocking; call via run_in_threadpool)"""
+    vector_store = _get_vstore(user_id)
+    vector_store._collection.add(
+        ids=[str(uuid.uuid4()) for _ in chunks],
+        embeddings=embeddings,
+        documents=chunks,
+        metadatas=[metadata] * len(chunks)
+    )
+    vector_store.persist()
+
+def _count_documents(user_id: str) -> int:
+    return _get_vstore(user_id)._collection.count()
+
+# Only quota and timeout errors are worth retrying; auth and request errors never recover
+GEMINI_MAX_RETRIES = 3
+GEMINI_RETRY_BASE_DELAY = 0.2
+_TRANSIENT_GEMINI_ERRORS = (ResourceExhausted, DeadlineExceeded)
+
+async def _generate_with_retry(message: str):
+    """Call Gemini off the event loop, backing off exponentially on transient errors"""
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return await run_in_threadpool(gemini_model.generate_content, message)
+        except _TRANSIENT_GEMINI_ERRORS as api_error:
+            logging.warning(f"Gemini API attempt {attempt + 1} failed: {str(api_error)}")
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(GEMINI_RETRY_BASE_DELAY * (2 ** attempt))
+
+# Blocking parsing, Chroma and Gemini calls run in the threadpool; widen it past anyio's default of 40
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+@app.on_event("startup")
+def configure_threadpool():
+    current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
 
 # Text extraction functions
-def extract_text_from_pdf(content):
-    """Extract text from PDF content"""
+# The PDF worker pool is shared with file_processing and stopped with the app
+app.on_event("shutdown")(shutdown_pdf_pool)
+
+def extract_text_from_pdf(stream):
+    """Extract text from a PDF file object"""
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text.strip()
+        if fitz is not None:
+            # PyMuPDF needs the raw bytes
+            content = stream.read()
+            # MuPDF extracts in C; PyPDF2 stays as the fallback for PDFs it rejects
+            try:
+                with fitz.open(stream=content, filetype="pdf") as doc:
+                    page_count = len(doc)
+                    if page_count <= PDF_PARALLEL_MIN_PAGES:
+                        return "\n".join(page.get_text("text") for page in doc).strip()
+                
+                # MuPDF is not thread-safe, so large PDFs are split across processes,
+                # which open a temporary copy by path rather than each receiving the bytes
+                ranges = _pdf_page_ranges(page_count, PDF_WORKERS)
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+                    tmp.write(content)
+                    tmp.flush()
+                    parts = get_pdf_pool().map(
+                        _extract_pdf_page_range,
+                        repeat(tmp.name),
+                        [start for start, _ in ranges],
+                        [end for _, end in ranges]
+                    )
+                    return "\n".join(parts).strip()
+            except Exception as e:
+                logging.warning(f"PyMuPDF could not read PDF, falling back to PyPDF2: {e}")
+                stream.seek(0)
+        
+        pdf_reader = PyPDF2.PdfReader(stream)
+        return "\n".join(page.extract_text() for page in pdf_reader.pages).strip()
     except Exception as e:
         logging.error(f"Error extracting PDF text: {e}")
         return f"Error extracting PDF content: {str(e)}"
 
-def extract_text_from_docx(content):
-    """Extract text from DOCX content"""
+def extract_text_from_docx(stream):
+    """Extract text from a DOCX file object"""
     try:
-        doc = docx.Document(io.BytesIO(content))
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text.strip()
+        doc = docx.Document(stream)
+        return "\n".join(paragraph.text for paragraph in doc.paragraphs).strip()
     except Exception as e:
         logging.error(f"Error extracting DOCX text: {e}")
         return f"Error extracting DOCX content: {str(e)}"
 
-def extract_text_from_csv(content):
-    """Extract text from CSV content"""
+def extract_text_from_csv(stream):
+    """Extract text from a CSV file object"""
     try:
-        csv_reader = csv.reader(io.StringIO(content.decode('utf-8')))
-        text = ""
-        for row in csv_reader:
-            text += ", ".join(row) + "\n"
-        return text.strip()
+        # Decode rows straight off the upload stream instead of materialising the whole file
+        text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        try:
+            return "\n".join(map(", ".join, csv.reader(text_stream))).strip()
+        finally:
+            text_stream.detach()  # leave the upload's file open for FastAPI to close
     except Exception as e:
         logging.error(f"Error extracting CSV text: {e}")
         return f"Error extracting CSV content: {str(e)}"
 
 def extract_text_from_file(file):
-    """Extract text from uploaded file"""
-    content = file.file.read()
+    """Extract text from uploaded file
+    
+    Extractors read the upload's spooled file directly, so no second full
+    copy of the raw bytes is made (except for PDFs opened with PyMuPDF).
+    """
     file_extension = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
     
     if file_extension in ['txt', 'md']:
+        text_stream = io.TextIOWrapper(file.file, encoding='utf-8', errors='ignore')
         try:
-            return content.decode('utf-8')
-        except UnicodeDecodeError:
-            return content.decode('utf-8', errors='ignore')
+            return text_stream.read()
+        finally:
+            text_stream.detach()
     elif file_extension == 'pdf':
-        return extract_text_from_pdf(content)
+        return extract_text_from_pdf(file.file)
     elif file_extension == 'docx':
-        return extract_text_from_docx(content)
+        return extract_text_from_docx(file.file)
     elif file_extension == 'csv':
-        return extract_text_from_csv(content)
+        return extract_text_from_csv(file.file)
     else:
         return f"Content from {file.filename} (file type: {file_extension} - text extraction not supported)"
 
 # Simple auth functions
+# Argon2id with the same parameters as main.py and auth.py; salt is embedded in the hash
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 def hash_password(password: str) -> str:
-    salt = secrets.token_hex(16)
-    password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}:{password_hash}"
+    return _ph.hash(password)
 
 def verify_password(password: str, hashed_password: str) -> bool:
     try:
-        salt, password_hash = hashed_password.split(":")
-        return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
-    except:
+        return _ph.verify(hashed_password, password)
+    except (VerificationError, InvalidHash):
         return False
 
 def create_token(user_id: str) -> str:
@@ -225,7 +358,7 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
             raise HTTPException(status_code=400, detail="No file provided")
         
         # 1. Extract text
-        text = extract_text_from_file(file)
+        text = await run_in_threadpool(extract_text_from_file, file)
         
         if len(text) == 0:
             raise HTTPException(status_code=400, detail="Empty file provided")
@@ -233,34 +366,28 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
         print(f"DEBUG: Extracted text length: {len(text)}")
         
         # 2. Process and store in vector database
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_text(text)
+        chunks = _SPLITTER.split_text(text)
         
         doc_id = f"doc_{int(time.time())}"
-        documents = [
-            Document(page_content=chunk, metadata={"doc_id": doc_id, "user_id": user["user_id"], "filename": file.filename})
-            for chunk in chunks
-        ]
+        metadata = {"doc_id": doc_id, "user_id": user["user_id"], "filename": file.filename}
         
         # 3. Add to existing vector store or create new
         try:
-            vector_store = Chroma.from_documents(
-                documents=documents,
-                embedding=GoogleGenerativeAIEmbeddings(model="models/embedding-001"),
-                collection_name=f"user_{user['user_id']}",
-                persist_directory=f"./chroma_db_{user['user_id']}"
-            )
-            vector_store.persist()
+            if _EMBEDDINGS is None:
+                raise Exception("Embeddings not configured")
+            embeddings = await _embed_chunks(chunks)
+            await run_in_threadpool(_store_chunks, user["user_id"], chunks, embeddings, metadata)
         except Exception as e:
             logging.warning(f"Vector store creation failed: {e}, using simple storage")
             # Fallback to simple storage
-            content_id = f"content_{int(time.time())}"
+            content_id = f"content_{uuid.uuid4().hex}"
             uploaded_content[content_id] = {
                 "filename": file.filename,
                 "content": text,
                 "user_id": user["user_id"],
                 "upload_time": time.time()
             }
+            user_content_index[user["user_id"]].append(content_id)
         
         print(f"DEBUG: File uploaded successfully with ID: {doc_id}")
         
@@ -284,14 +411,16 @@ async def list_content(user: dict = Depends(get_current_user)):
         
         # Get simple stored content
         user_content = []
-        for content_id, content_data in uploaded_content.items():
-            if content_data.get('user_id') == user.get('user_id'):
-                user_content.append({
-                    "id": content_id,
-                    "filename": content_data.get('filename', 'Unknown'),
-                    "size": content_data.get('size', 0),
-                    "upload_time": content_data.get('upload_time', 0)
-                })
+        for content_id in user_content_index.get(user.get('user_id'), []):
+            content_data = uploaded_content.get(content_id)
+            if content_data is None or content_data.get('user_id') != user.get('user_id'):
+                continue
+            user_content.append({
+                "id": content_id,
+                "filename": content_data.get('filename', 'Unknown'),
+                "size": content_data.get('size', 0),
+                "upload_time": content_data.get('upload_time', 0)
+            })
         
         print(f"DEBUG: Found {len(user_content)} files for user")
         
@@ -311,20 +440,12 @@ async def chat_general(message: str = Form(...)):
             raise HTTPException(status_code=500, detail="Gemini API not configured")
         
         # Call real Gemini API with retry logic
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = gemini_model.generate_content(message)
-                return {
-                    "response": response.text,
-                    "source": "general"
-                }
-            except Exception as api_error:
-                logging.warning(f"Gemini API attempt {attempt + 1} failed: {str(api_error)}")
-                if attempt == max_retries - 1:
-                    raise api_error
-                time.sleep(1)  # Wait 1 second before retry
-                
+        response = await _generate_with_retry(message)
+        return {
+            "response": response.text,
+            "source": "general"
+        }
+        
     except Exception as e:
         logging.error(f"Error generating response: {str(e)}")
         return {
@@ -340,26 +461,12 @@ async def chat_rag(message: str = Form(...), user: dict = Depends(get_current_us
         
         # Check if user has documents in vector store
         try:
-            vector_store = Chroma(
-                collection_name=f"user_{user['user_id']}",
-                embedding_function=GoogleGenerativeAIEmbeddings(model="models/embedding-001"),
-                persist_directory=f"./chroma_db_{user['user_id']}"
-            )
-            
             # If no documents or error, use general Gemini
-            if vector_store._collection.count() == 0:
+            if await run_in_threadpool(_count_documents, user["user_id"]) == 0:
                 raise Exception("No documents found")
             
             # Use RAG with documents
-            retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=ChatGoogleGenerativeAI(model="gemini-1.5-flash"),
-                chain_type="stuff",
-                retriever=retriever,
-                return_source_documents=False
-            )
-            
-            result = qa_chain.invoke({"query": message})
+            result = await run_in_threadpool(_get_chain(user["user_id"]).invoke, {"query": message})
             return {
                 "response": result["result"],
                 "source": "documents",
@@ -370,21 +477,13 @@ async def chat_rag(message: str = Form(...), user: dict = Depends(get_current_us
             logging.warning(f"RAG processing failed: {rag_error}, falling back to general chat")
             
             # Fallback to general Gemini
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = gemini_model.generate_content(message)
-                    return {
-                        "response": response.text,
-                        "source": "general",
-                        "sources": []
-                    }
-                except Exception as api_error:
-                    logging.warning(f"Gemini API attempt {attempt + 1} failed: {str(api_error)}")
-                    if attempt == max_retries - 1:
-                        raise api_error
-                    time.sleep(1)  # Wait 1 second before retry
-                    
+            response = await _generate_with_retry(message)
+            return {
+                "response": response.text,
+                "source": "general",
+                "sources": []
+            }
+            
     except Exception as e:
         logging.error(f"Error generating RAG response: {str(e)}")
         return {
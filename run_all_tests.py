@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+from test_urgent_fixes import flush_log, labelled, logger, start_backend, make_client, warm_endpoints, test_urgent_fixes
+from test_final_auth import test_complete_auth_flow
+
+# libuv-backed event loop for the concurrent flows, when installed
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+async def run_all():
+    # One client, and so one connection pool, drives every flow concurrently
+    async with make_client() as client:
+        await warm_endpoints(client)
+        return await asyncio.gather(
+            labelled("final-auth", test_complete_auth_flow(client)),
+            labelled("urgent", test_urgent_fixes(client))
+        )
+
+if __name__ == "__main__":
+    # Start the backend once for the whole suite
+    backend_process = start_backend()
+    
+    try:
+        final_auth, urgent_fixes = asyncio.run(run_all())
+        logger.info(f"\n🎯 FINAL AUTH RESULT: {'✅ SUCCESS' if final_auth else '❌ FAILED'}")
+        logger.info(f"🎯 URGENT FIXES RESULT: {'✅ SUCCESS' if urgent_fixes else '❌ FAILED'}")
+    finally:
+        # Clean up
+        if backend_process:
+            backend_process.terminate()
+            logger.info("\n🧹 Backend process terminated")
+        flush_log()
@@ -58,7 +58,7 @@ def test_critical_fixes():
         
         upload_response = requests.post(f"{base_url}/api/content/upload", files=files, headers=headers)
         
-        if upload_response.status_code == 200:
+        if upload_response.status_code in (200, 202):
             print("   ✅ UPLOAD SUCCESS: Authentication working")
             return True
         else:
@@ -84,7 +84,7 @@ def test_document_upload():
         
         upload_response = requests.post(f"{base_url}/api/content/upload", files=files, headers=headers)
         
-        if upload_response.status_code == 200:
+        if upload_response.status_code in (200, 202):
             data = upload_response.json()
             print(f"   ✅ Document upload working!")
             print(f"   File: {data.get('filename')}")
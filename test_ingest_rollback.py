@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+def _make_pipeline():
+    """Pipeline on a throwaway Chroma directory, embedding with the 384-d hash fallback"""
+    os.environ.pop("GEMINI_API_KEY", None)
+    import rag_pipeline
+    rag_pipeline.SENTENCE_TRANSFORMERS_AVAILABLE = False
+    os.chdir(tempfile.mkdtemp())
+    return rag_pipeline.RAGPipeline()
+
+def _chunk_ids(pipeline, user_id):
+    return pipeline.collection.get(where=pipeline._user_filter(user_id), include=[])['ids']
+
+def test_failed_flush_midway():
+    print("🧪 FAILED FLUSH ROLLBACK TEST")
+    print("=============================")
+
+    pipeline = _make_pipeline()
+    text_a = "Photosynthesis converts light energy into chemical energy. " * 40
+    text_b = "Mountains are formed by tectonic forces over millions of years. " * 40
+    text_c = "Rivers carry sediment from the highlands down to the sea. " * 40
+
+    # Stored before the failure; fixes the collection's dimension at 384
+    kept_id = pipeline.add_document("u1", text_c, "c.txt", "text")
+
+    # A is fine, B has embeddings of the wrong dimension; both stay buffered
+    id_a = pipeline.add_document("u1", text_a, "a.txt", "text", flush=False)
+    embed = pipeline.generate_embeddings
+    pipeline.generate_embeddings = lambda texts: np.ones((len(texts), 768), dtype=np.float32)
+    id_b = pipeline.add_document("u1", text_b, "b.txt", "text", flush=False)
+    pipeline.generate_embeddings = embed
+
+    # Small batches so the flush spans several add() calls, with A's last chunk beside B's first
+    pipeline._ingester.batch_size = len(pipeline.chunk_text(text_a)) - 1
+    
+    print("1. Flushing a buffer whose middle batch fails...")
+    failures = pipeline.flush()
+    assert set(failures) == {id_a, id_b}, f"Flush reported {sorted(failures)}, expected both failed documents"
+    print(f"   ✅ Flush reported: {str(failures[id_b])[:60]}")
+
+    print("2. Checking the failed documents were dropped and rolled back...")
+    stored = set(_chunk_ids(pipeline, "u1"))
+    assert not any(chunk_id.startswith((id_a, id_b)) for chunk_id in stored), f"Failed documents left behind: {sorted(stored)}"
+    assert not pipeline._ingester.ids, "Failed records are still buffered"
+    assert any(chunk_id.startswith(kept_id) for chunk_id in stored), "Previously stored document was lost"
+    assert ("u1", id_b) not in pipeline._doc_hashes and not pipeline._pending_hashes, "Failed documents are still indexed by content hash"
+    print("   ✅ Only the earlier document remains")
+
+    print("3. Checking the store keeps working...")
+    assert not pipeline.flush(), "Failures were reported twice"
+    new_id_b = pipeline.add_document("u1", text_b, "b.txt", "text")
+    new_id_a = pipeline.add_document("u1", text_a, "a.txt", "text")
+    stats = pipeline.get_collection_stats("u1")
+    assert new_id_b != id_b and new_id_a != id_a, "Re-upload returned the id of a document that was never stored"
+    assert stats["unique_documents"] == 3, f"Unexpected stats after re-upload: {stats}"
+    print(f"   ✅ Re-uploads stored as new documents: {stats}")
+
+def test_failure_reported_to_its_document():
+    print("\n🧪 PER-DOCUMENT FAILURE TEST")
+    print("============================")
+
+    pipeline = _make_pipeline()
+    pipeline.add_document("u1", "Rivers carry sediment from the highlands down to the sea. " * 40, "c.txt", "text")
+
+    # A is buffered with embeddings of the wrong dimension; B's call flushes it
+    text_a = "Glaciers carve valleys as they slowly move. " * 40
+    embed = pipeline.generate_embeddings
+    pipeline.generate_embeddings = lambda texts: np.ones((len(texts), 768), dtype=np.float32)
+    id_a = pipeline.add_document("u1", text_a, "a.txt", "text", flush=False)
+    pipeline.generate_embeddings = embed
+    # A fills a batch of its own, so B is written by a later batch of the same flush
+    pipeline._ingester.batch_size = len(pipeline.chunk_text(text_a))
+
+    print("1. Adding a good document whose flush also writes the bad one...")
+    id_b = pipeline.add_document("u1", "Volcanoes release gas and molten rock. " * 40, "b.txt", "text")
+    stored = set(_chunk_ids(pipeline, "u1"))
+    assert any(chunk_id.startswith(id_b) for chunk_id in stored), "Good document was not stored"
+    assert not any(chunk_id.startswith(id_a) for chunk_id in stored), "Failed document left behind"
+    print("   ✅ Good document stored without raising")
+
+    print("2. Checking the failure is reported for its own document...")
+    failures = pipeline.flush()
+    assert set(failures) == {id_a}, f"Unexpected failures: {sorted(failures)}"
+    print("   ✅ flush() reported only the failed document")
+
+if __name__ == "__main__":
+    try:
+        test_failed_flush_midway()
+        test_failure_reported_to_its_document()
+        success = True
+    except AssertionError as e:
+        print(f"   ❌ {e}")
+        success = False
+    print(f"\n🎯 ROLLBACK RESULT: {'✅ SUCCESS' if success else '❌ FAILED'}")